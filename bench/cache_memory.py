@@ -0,0 +1,125 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+
+DbCache memory benchmark
+
+Loads synthetic user_data and guild_prefs rows into DbCache with and
+without `compact`, and reports the memory used per 100k rows. Run from the
+repository root:
+
+    python -m bench.cache_memory --rows 100000
+"""
+import argparse
+import asyncio
+import random
+import tracemalloc
+
+from neo.types import DbCache
+from tabulate import tabulate
+
+
+def user_row(rng, user_id):
+    return {
+        "user_id": user_id,
+        "repr_errors": rng.random() < 0.05,
+        "error_emojis": rng.random() < 0.05,
+        "hl_blocks": [rng.getrandbits(63)] if rng.random() < 0.02 else [],
+        "hl_whitelist": [],
+        "can_snipe": rng.random() > 0.01,
+        "_blacklisted": False,
+    }
+
+
+def guild_row(rng, guild_id):
+    return {
+        "guild_id": guild_id,
+        "prefixes": ["n/"],
+        "index_emojis": True,
+        "snipes": rng.random() < 0.2,
+        "starboard": rng.random() < 0.1,
+        "starboard_star_requirement": 5,
+        "starboard_channel_id": None,
+        "starboard_format": ":star: **{stars}**",
+        "starboard_max_days": 7,
+        "counting_channel": None,
+    }
+
+
+class Pool:
+    """Hands out pregenerated rows in place of asyncpg"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def fetch(self, query, *args):
+        return self.rows
+
+
+async def measure(rows, key, compact):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    cache = await DbCache(db_query="", pool=Pool(rows), key=key, compact=compact)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert len(cache) == len(rows)
+    return used
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    count = args.rows
+    tables = {
+        "user_data": ("user_id", [user_row(rng, 10 ** 17 + i) for i in range(count)]),
+        "guild_prefs": (
+            "guild_id",
+            [guild_row(rng, 10 ** 17 + i) for i in range(count)],
+        ),
+    }
+    results = []
+    for table, (key, rows) in tables.items():
+        plain = await measure(rows, key, False)
+        compact = await measure(rows, key, True)
+        scale = 100000 / len(rows) / 2 ** 20
+        results.append(
+            [
+                table,
+                plain * scale,
+                compact * scale,
+                (plain - compact) * scale,
+                (plain - compact) / len(rows),
+            ]
+        )
+    print(
+        tabulate(
+            results,
+            headers=[
+                "table",
+                "dict MB/100k",
+                "compact MB/100k",
+                "saved MB/100k",
+                "saved B/row",
+            ],
+            floatfmt=".2f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DbCache memory benchmark")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
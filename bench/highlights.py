@@ -0,0 +1,312 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+
+Highlight engine throughput benchmark
+
+Generates synthetic guilds, members, highlights and messages, then drives
+them through HlMon.watch_highlights and Highlight.check_can_send with a
+stubbed bot. Run from the repository root (a config.yml is needed, since
+importing neo loads it):
+
+    python -m bench.highlights --sizes 1000 10000 100000 --save baseline.json
+    python -m bench.highlights --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import string
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+from neo.ext.highlight import HlMon, check_regex
+from tabulate import tabulate
+
+WORD_LENGTHS = {3: 8, 4: 14, 5: 16, 6: 14, 7: 12, 8: 10, 9: 8, 10: 6, 11: 4, 12: 3}
+# {0}, {1} and {2} are words, {3} is a single letter
+REGEX_TEMPLATES = (
+    "{0}s?",
+    "(?:{0}|{1})",
+    "{0}[{3}x]",
+    "\\b{0}\\b",
+    "{0}\\s{1}",
+    "(?:{0}|{1}|{2})s?",
+)
+
+
+class Permissions:
+    read_messages = True
+
+
+class Guild:
+    def __init__(self, id, members):
+        self.id = id
+        self.name = f"guild-{id}"
+        self._members = {m.id: m for m in members}
+
+    @property
+    def members(self):
+        return [*self._members.values()]
+
+    def get_member(self, user_id):
+        return self._members.get(user_id)
+
+
+class Channel:
+    def __init__(self, id, guild):
+        self.id = id
+        self.guild = guild
+        self.name = f"channel-{id}"
+
+    def permissions_for(self, member):
+        return Permissions()
+
+
+class StubBot:
+    """Just enough of NeoBot for HlMon to run without a gateway connection"""
+
+    def __init__(self, loop, guilds, users):
+        self.loop = loop
+        self.guilds = guilds
+        self.users = users
+        self.user_cache = {}
+        self.pipeline = SimpleNamespace(
+            add_stage=lambda *args, **kwargs: None, remove_stage=lambda name: None
+        )
+
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    def dispatch(self, *args, **kwargs):
+        pass
+
+    async def wait_until_ready(self):
+        await asyncio.Event().wait()  # Never ready, so startup loads don't run
+
+
+def make_words(rng, count):
+    lengths = rng.choices([*WORD_LENGTHS], weights=[*WORD_LENGTHS.values()], k=count)
+    return [
+        "".join(rng.choices(string.ascii_lowercase, k=length)) for length in lengths
+    ]
+
+
+def make_highlights(rng, words, count, regex_ratio):
+    """Returns {user_id: [row, ...]} with at most 10 highlights per user"""
+    users = {}
+    user_id = 0
+    made = 0
+    while made < count:
+        user_id += 1
+        rows = []
+        for _ in range(min(rng.randint(1, 10), count - made)):
+            if rng.random() < regex_ratio:
+                picked = rng.sample(words, 4)
+                kw = rng.choice(REGEX_TEMPLATES).format(*picked[:3], picked[3][0])
+                try:
+                    check_regex(kw)
+                except ValueError:
+                    continue
+                rows.append(
+                    {"user_id": user_id, "kw": kw, "is_regex": True, "disabled": False}
+                )
+            else:
+                kw = " ".join(rng.sample(words, rng.choices([1, 2, 3], [7, 2, 1])[0]))
+                rows.append(
+                    {"user_id": user_id, "kw": kw, "is_regex": False, "disabled": False}
+                )
+        made += len(rows)
+        users[user_id] = rows
+    return users
+
+
+def make_world(rng, owners, guild_count, members_per_guild):
+    authors = [
+        SimpleNamespace(
+            id=10 ** 9 + i,
+            name=f"member{i}",
+            bot=False,
+            default_avatar=SimpleNamespace(value=i % 5),
+        )
+        for i in range(members_per_guild)
+    ]
+    guilds = []
+    for guild_id in range(1, guild_count + 1):
+        members = rng.sample(authors, members_per_guild // 2) + [
+            SimpleNamespace(id=owner) for owner in rng.sample(owners, len(owners) // 4)
+        ]
+        guilds.append(Guild(guild_id, members))
+    return guilds, authors
+
+
+def make_messages(rng, words, highlight_words, guilds, authors, count, hit_ratio):
+    channels = [Channel(guild.id * 100 + i, guild) for guild in guilds for i in range(3)]
+    messages = []
+    for message_id in range(1, count + 1):
+        content = rng.choices(words, k=rng.randint(5, 30))
+        if rng.random() < hit_ratio:
+            content.insert(rng.randrange(len(content)), rng.choice(highlight_words))
+        channel = rng.choice(channels)
+        messages.append(
+            SimpleNamespace(
+                id=message_id,
+                content=" ".join(content),
+                guild=channel.guild,
+                channel=channel,
+                author=rng.choice(authors),
+                embeds=[],
+                attachments=[],
+                jump_url=f"https://discord.com/channels/{channel.guild.id}/{channel.id}/{message_id}",
+                created_at=datetime.utcnow(),
+            )
+        )
+    return messages
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_size(size, args):
+    rng = random.Random(args.seed)
+    words = make_words(rng, args.vocabulary)
+    highlights = make_highlights(rng, words, size, args.regex_ratio)
+    guilds, authors = make_world(rng, [*highlights], args.guilds, args.members)
+    users = {uid: SimpleNamespace(id=uid) for uid in highlights}
+    bot = StubBot(asyncio.get_event_loop(), guilds, users)
+
+    def build():
+        cog = HlMon(bot)
+        cog.index_owners(
+            {
+                user_id: None
+                for user_id, rows in highlights.items()
+                if cog.patch_user(user_id, rows)
+            }
+        )
+        return cog
+
+    # Memory is measured on a separate build, since tracing slows it down
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    build().cog_unload()
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    build_start = time.perf_counter()
+    cog = build()
+    build_time = time.perf_counter() - build_start
+
+    literal_words = [
+        row["kw"] for rows in highlights.values() for row in rows if not row["is_regex"]
+    ]
+    messages = make_messages(
+        rng, words, literal_words, guilds, authors, args.messages, args.hit_ratio
+    )
+
+    latencies = []
+    started = time.perf_counter()
+    for msg in messages:
+        if not cog.index.guilds.get(msg.guild.id):  # As the pipeline would
+            continue
+        start = time.perf_counter()
+        await cog.watch_highlights(msg)
+        latencies.append(time.perf_counter() - start)
+        if len(cog.dispatcher.queues) > 500:  # Stand in for the periodic flush
+            cog.dispatcher.queues.clear()
+            cog.dispatcher.pending = 0
+    elapsed = time.perf_counter() - started
+
+    # Checks are timed in a pass of their own, so throughput only covers
+    # watch_highlights
+    checks = []
+    for msg in messages:
+        if not cog.index.guilds.get(msg.guild.id):
+            continue
+        for hl, _ in cog.matcher.scan(msg.content):
+            start = time.perf_counter()
+            hl.check_can_send(msg, cog.index)
+            checks.append(time.perf_counter() - start)
+
+    cog.cog_unload()
+    return {
+        "highlights": len(cog.matcher),
+        "users": len(highlights),
+        "build_s": build_time,
+        "memory_mb": memory / 2 ** 20,
+        "msgs_per_s": len(messages) / elapsed,
+        "p50_us": percentile(latencies, 0.50) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+        "check_p50_us": percentile(checks, 0.50) * 1e6 if checks else 0.0,
+        "queued": cog.dispatcher.stats["queued"],
+    }
+
+
+def compare(results, baseline):
+    rows = []
+    for size, result in results.items():
+        if (base := baseline.get(size)) is None:
+            continue
+        rows.append(
+            [
+                size,
+                *(
+                    f"{(result[key] - base[key]) / base[key] * 100:+.1f}%"
+                    if base[key]
+                    else "n/a"
+                    for key in ("msgs_per_s", "p50_us", "p99_us", "memory_mb")
+                ),
+            ]
+        )
+    print("\nChange against baseline")
+    print(tabulate(rows, headers=["size", "msgs/s", "p50", "p99", "memory"]))
+
+
+async def main(args):
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = await run_size(size, args)
+    print(
+        tabulate(
+            [[size, *result.values()] for size, result in results.items()],
+            headers=["size", *next(iter(results.values())).keys()],
+            floatfmt=".2f",
+        )
+    )
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump(results, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Highlight engine throughput benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--regex-ratio", type=float, default=0.2)
+    parser.add_argument("--hit-ratio", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="Record the results as a baseline")
+    parser.add_argument("--compare", help="Compare against a recorded baseline")
+    asyncio.run(main(parser.parse_args()))
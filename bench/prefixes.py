@@ -0,0 +1,131 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+
+Prefix resolution benchmark
+
+Compares the old per-message prefix resolution (rebuilding the prefix list
+and when_mentioned_or on every message) with PrefixIndex, over a mix of
+guild messages where only a few are commands. Only prefix resolution and
+matching are timed; the old path also built a Context for every message,
+which the fast reject now skips, so real savings are larger. Run from the
+repository root:
+
+    python -m bench.prefixes --messages 200000
+"""
+import argparse
+import asyncio
+import random
+import time
+from contextlib import suppress
+from types import SimpleNamespace
+
+from neo.core.prefixes import PrefixIndex
+from tabulate import tabulate
+
+
+class StubBot:
+    def __init__(self, guild_cache):
+        self.user = SimpleNamespace(id=10 ** 17)
+        self.guild_cache = guild_cache
+        self.ready = asyncio.Event()
+        self.ready.set()
+        self.prefixes = PrefixIndex(self)
+
+    def is_closed(self):
+        return False
+
+    def is_ready(self):
+        return self.ready.is_set()
+
+    async def wait_until_ready(self):
+        await self.ready.wait()
+
+
+def when_mentioned_or(*prefixes):
+    # As in discord.ext.commands
+    def inner(bot, msg):
+        return [f"<@{bot.user.id}> ", f"<@!{bot.user.id}> ", *prefixes]
+
+    return inner
+
+
+async def legacy_get_prefix(bot, message):
+    if bot.is_closed():
+        return
+    await bot.wait_until_ready()
+    prefix = ["n/"]
+    if message.guild:
+        with suppress(KeyError):
+            prefix = list({*bot.guild_cache[message.guild.id]["prefixes"]})
+    return when_mentioned_or(*prefix)(bot, message)
+
+
+async def legacy(bot, message):
+    prefix = list(await legacy_get_prefix(bot, message))  # As in Bot.get_prefix
+    return message.content.startswith(tuple(prefix))
+
+
+async def indexed(bot, message):
+    return bot.prefixes.matches(message)
+
+
+def make_messages(rng, guild_cache, count, command_ratio):
+    words = ["hello", "there", "general", "kenobi", "neo", "bot", "what", "lol"]
+    guild_ids = [*guild_cache]
+    messages = []
+    for _ in range(count):
+        guild_id = rng.choice(guild_ids)
+        content = " ".join(rng.choices(words, k=rng.randint(1, 12)))
+        if rng.random() < command_ratio:
+            content = rng.choice(guild_cache[guild_id]["prefixes"]) + content
+        messages.append(
+            SimpleNamespace(content=content, guild=SimpleNamespace(id=guild_id))
+        )
+    return messages
+
+
+async def run(resolve, bot, messages):
+    matched = 0
+    start = time.perf_counter()
+    for message in messages:
+        matched += await resolve(bot, message)
+    return len(messages) / (time.perf_counter() - start), matched
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    guild_cache = {
+        guild_id: {"prefixes": rng.sample(["n/", "n!", "?", ">>", "neo "], 2)}
+        for guild_id in range(args.guilds)
+    }
+    bot = StubBot(guild_cache)
+    messages = make_messages(rng, guild_cache, args.messages, args.command_ratio)
+    results = []
+    for name, resolve in (("before", legacy), ("after", indexed)):
+        rate, matched = await run(resolve, bot, messages)
+        results.append([name, rate, matched])
+    print(tabulate(results, headers=["", "msgs/s", "matched"], floatfmt=",.0f"))
+    print(f"\nSpeedup: {results[1][1] / results[0][1]:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prefix resolution benchmark")
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--guilds", type=int, default=1000)
+    parser.add_argument("--command-ratio", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
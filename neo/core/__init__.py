@@ -23,6 +23,13 @@ import neo
 import sys
 from .config_loader import *  # noqa
 from .context import Context
+from .logs import setup_logging
+from .metrics import Metrics, MetricsServer, timed_listener
+from .pipeline import MessagePipeline
+from .prefixes import PrefixIndex
+from .ratelimit import RateLimiter, get_rate_cost
+from .sync import CacheSync
+from .tracing import IOStats, TracedPool, trace_config
 from contextlib import suppress
 from discord.ext import commands
 from neo.types import DbCache
@@ -51,62 +58,27 @@ if sys.platform == "win32":
     windll.kernel32.SetConsoleMode(windll.kernel32.GetStdHandle(-11), 7)
 
 LOGGERS = [("discord", logging.INFO), ("neo", logging.INFO)]
-
-
-class ColouredFormatter(logging.Formatter):
-    prefix = "\x1b[38;5;"
-    codes = {
-        "INFO": prefix + "2m",
-        "WARN": prefix + "100m",
-        "DEBUG": prefix + "26m",
-        "ERROR": prefix + "1m",
-        "WARNING": prefix + "220m",
-        "_RESET": "\x1b[0m",
-    }
-
-    def format(self, record: logging.LogRecord):
-        if record.levelname in self.codes:
-            record.msg = (
-                self.codes[record.levelname] + str(record.msg) + self.codes["_RESET"]
-            )
-            record.levelname = (
-                self.codes[record.levelname] + record.levelname + self.codes["_RESET"]
-            )
-        return super().format(record)
-
-
-for name, level in LOGGERS:
-    log_ = logging.getLogger(name)
-    handler = logging.StreamHandler()
-    formatter = ColouredFormatter(
-        fmt="[{asctime} {levelname}/{name}] {message}", style="{"
-    )
-    formatter.datefmt = (
-        "\x1b[38;2;132;206;255m" + "%d/%m/%Y %H:%M:%S" + formatter.codes["_RESET"]
-    )
-
-    handler.setFormatter(formatter)
-    log_.setLevel(level)
-    log_.addHandler(handler)
+log_settings = conf.get("logging") or {}
+log_listener = setup_logging(
+    LOGGERS,
+    json_output=log_settings.get("json", False),
+    queue_size=log_settings.get("queue_size", 10000),
+)
 
 
 async def get_prefix(bot, message):
     if bot.is_closed():
         return
-    await bot.wait_until_ready()
-    prefix = ["n/"]
-    if message.guild:
-        with suppress(
-            KeyError
-        ):  # Not sure why this *would* happen but I guess it could
-            prefix = list({*bot.guild_cache[message.guild.id]["prefixes"]})
-    return commands.when_mentioned_or(*prefix)(bot, message)
+    if not bot.is_ready():
+        await bot.wait_until_ready()
+    return bot.prefixes.for_message(message)
 
 
 class NeoBot(commands.Bot):
     """The bot itself"""
 
     def __init__(self):
+        self._timed_listeners = {}  # (listener, event name) -> timed wrapper
         super().__init__(
             command_prefix=get_prefix,
             case_insensitive=True,
@@ -128,35 +100,157 @@ class NeoBot(commands.Bot):
             ),
         )
         self.snipes = {}
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.io_stats = IOStats()
+        self.prefixes = PrefixIndex(self)
+        self.pipeline = MessagePipeline(self)
+        self.pipeline.add_stage(
+            "commands", self.command_stage, when=self.could_be_command, background=True
+        )
         self.loop.create_task(self.__ainit__())
-        self._cd = commands.CooldownMapping.from_cooldown(
-            2.0, 2.5, commands.BucketType.user
+        settings = neo.conf.get("ratelimit") or {}
+        self.ratelimiter = RateLimiter(
+            settings.get("rate", 2.0),
+            settings.get("per", 2.5),
+            capacity=settings.get("capacity"),
+        )
+        self.command_costs = settings.get("costs") or {}
+        self._cooldown = commands.Cooldown(
+            self.ratelimiter.rate, self.ratelimiter.per, commands.BucketType.user
         )
         self.add_check(self.global_cooldown, call_once=True)
         self.add_check(self.check_blacklist)
         self.before_invoke(self.before)
+        self.after_invoke(self.after)
+        self.add_listener(self.count_command_error, "on_command_error")
+        self.add_gauges()
 
         for ext in neo.conf["exts"]:
             self.load_extension(ext)
 
     async def __ainit__(self):
-        self.session = aiohttp.ClientSession()
-        self.pool = await asyncpg.create_pool(**neo.secrets.database)
+        self.session = aiohttp.ClientSession(
+            trace_configs=[trace_config(self.io_stats)]
+        )
+        self.cache_sync = CacheSync(self)
+        self.pool = TracedPool(
+            await asyncpg.create_pool(
+                **neo.secrets.database, init=self.cache_sync.register
+            ),
+            self.io_stats,
+        )
+        settings = neo.conf.get("user_cache") or {}
         self.user_cache = await DbCache(
-            db_query="SELECT * FROM user_data", key="user_id", pool=self.pool
+            db_query="SELECT * FROM user_data",
+            row_query="SELECT * FROM user_data WHERE user_id=ANY($1::BIGINT[])",
+            key="user_id",
+            pool=self.pool,
+            compact=True,
+            lazy=settings.get("lazy", False),
+            max_size=settings.get("max_size", 10000),
+            ttl=settings.get("ttl"),
+            negative_ttl=settings.get("negative_ttl", 300),
         )
         self.guild_cache = await DbCache(
-            db_query="SELECT * FROM guild_prefs", key="guild_id", pool=self.pool
+            db_query="SELECT * FROM guild_prefs",
+            row_query="SELECT * FROM guild_prefs WHERE guild_id=ANY($1::BIGINT[])",
+            key="guild_id",
+            pool=self.pool,
+            compact=True,
         )
+        self.cache_sync.start()
+        if (settings := neo.conf.get("metrics")) and settings.get("port"):
+            self.metrics_server = MetricsServer(
+                self.metrics,
+                host=settings.get("host", "127.0.0.1"),
+                port=settings["port"],
+            )
+            await self.metrics_server.start()
 
     def run(self):
         super().run(neo.secrets.bot_token)
 
+    async def on_message(self, message):
+        await self.pipeline.process(message)
+
+    def could_be_command(self, processed):
+        # Most messages can't be commands, so skip building a context for them
+        if not self.is_ready():
+            return True
+        return self.prefixes.matches(processed.message)
+
+    async def command_stage(self, processed):
+        await super().process_commands(processed.message)
+
+    async def process_commands(self, message):
+        if message.author.bot:
+            return
+        if self.is_ready() and not self.prefixes.matches(message):
+            return
+        await super().process_commands(message)
+
     async def get_context(self, message, *, cls=Context):
         return await super().get_context(message, cls=cls)
 
-    def check_blacklist(self, ctx):
-        if (p := self.user_cache.get(ctx.author.id)) :
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        # Command errors are handled inside of invoke, see count_command_error
+        with self.metrics.track("command", ctx.command.qualified_name) as timer:
+            try:
+                await super().invoke(ctx)
+            finally:
+                # Subcommands are resolved into ctx.command while invoking
+                timer.key = ("command", ctx.command.qualified_name)
+
+    async def can_run(self, ctx, *, call_once=False):
+        name = "global_once" if call_once else "global"
+        with self.metrics.track("check", name):
+            return await super().can_run(ctx, call_once=call_once)
+
+    def add_listener(self, func, name=None):
+        # Listeners are timed by wrapping them as they're added
+        name = func.__name__ if name is None else name
+        timed = self._timed_listeners[func, name] = timed_listener(self.metrics, func)
+        super().add_listener(timed, name)
+
+    def remove_listener(self, func, name=None):
+        name = func.__name__ if name is None else name
+        super().remove_listener(self._timed_listeners.pop((func, name), func), name)
+
+    async def count_command_error(self, ctx, error):
+        if ctx.command is not None:
+            self.metrics.errors["command", ctx.command.qualified_name] += 1
+
+    def add_gauges(self):
+        self.metrics.add_gauge("ratelimit_keys", lambda: {(): len(self.ratelimiter)})
+        self.metrics.add_gauge("ratelimit_bytes", lambda: {(): self.ratelimiter.memory})
+        self.metrics.add_gauge(
+            "cached_rows",
+            lambda: {
+                (("cache", name),): len(cache)
+                for name in ("user_cache", "guild_cache")
+                if (cache := getattr(self, name, None)) is not None
+            },
+        )
+        self.metrics.add_gauge(
+            "stage_calls",
+            lambda: {
+                (("stage", stage.name),): stage.calls
+                for stage in self.pipeline.stages.values()
+            },
+        )
+        self.metrics.add_gauge(
+            "stage_seconds",
+            lambda: {
+                (("stage", stage.name),): stage.total
+                for stage in self.pipeline.stages.values()
+            },
+        )
+
+    async def check_blacklist(self, ctx):
+        if (p := await self.user_cache.fetch(ctx.author.id)) :
             if p["_blacklisted"] is True:
                 raise neo.utils.errors.Blacklisted()
             else:
@@ -164,21 +258,52 @@ class NeoBot(commands.Bot):
         else:
             return True
 
-    async def global_cooldown(self, ctx):
-        bucket = self._cd.get_bucket(ctx.message)
-        retry_after = bucket.update_rate_limit()
+    def rate_cost(self, command):
+        return self.command_costs.get(command.qualified_name, get_rate_cost(command))
+
+    async def charge(self, ctx, cost):
+        retry_after = self.ratelimiter.hit(ctx.author.id, cost)
         if retry_after and not await self.is_owner(ctx.author):
-            raise commands.CommandOnCooldown(bucket, retry_after)
+            raise commands.CommandOnCooldown(self._cooldown, retry_after)
+
+    async def global_cooldown(self, ctx):
+        # This runs before subcommands are resolved, so only the root command
+        # is charged here, and subcommands costing more are topped up in before
+        ctx.rate_charged = self.rate_cost(ctx.command)
+        await self.charge(ctx, ctx.rate_charged)
         return True
 
+    async def charge_subcommand(self, ctx):
+        charged = getattr(ctx, "rate_charged", 0)
+        if (extra := self.rate_cost(ctx.command) - charged) > 0:
+            ctx.rate_charged = charged + extra
+            await self.charge(ctx, extra)
+
     async def before(self, ctx):
-        if not self.user_cache.get(ctx.author.id):
-            with suppress(asyncpg.exceptions.UniqueViolationError):
-                await self.pool.execute(
-                    "INSERT INTO user_data (user_id) VALUES ($1)", ctx.author.id
-                )
-                # Adds people to the user_data table whenever they execute their first command
-                await self.user_cache.refresh()  # And then updates the user cache
+        with self.metrics.track("hook", "before_invoke"):
+            await self.charge_subcommand(ctx)
+            await self.ensure_user(ctx)
+        # Runs once checks and conversion are done, so what's timed from here
+        # to `after` is only the callback. Hooks nest for groups' subcommands
+        if not hasattr(ctx, "callback_timers"):
+            ctx.callback_timers = []
+        ctx.callback_timers.append(
+            self.metrics.start("callback", ctx.command.qualified_name)
+        )
+
+    async def after(self, ctx):
+        if timers := getattr(ctx, "callback_timers", None):
+            timers.pop().stop(failed=ctx.command_failed)
+
+    async def ensure_user(self, ctx):
+        if not await self.user_cache.fetch(ctx.author.id):
+            # Adds people to the user_data table whenever they execute their first command
+            row = await self.pool.fetchrow(
+                "INSERT INTO user_data (user_id) VALUES ($1) ON CONFLICT (user_id) "
+                "DO UPDATE SET user_id=EXCLUDED.user_id RETURNING *",
+                ctx.author.id,
+            )
+            self.user_cache.upsert(ctx.author.id, row)  # And then caches their row
 
     async def on_ready(self):
         log.info("Received ready event")
@@ -187,8 +312,18 @@ class NeoBot(commands.Bot):
         }
 
     async def close(self):
+        # Cogs can write out anything they've buffered while still connected
+        for cog in [*self.cogs.values()]:
+            if hasattr(cog, "cog_close"):
+                try:
+                    await cog.cog_close()
+                except Exception as e:
+                    log.error(f"{type(cog).__name__}.cog_close failed: {e!r}")
         # wrapping all of them into a try except to let it die in peace
         await super().close()
         with suppress(Exception):
+            if self.metrics_server is not None:
+                await self.metrics_server.stop()
+            await self.cache_sync.stop()
             await self.session.close()
             await self.pool.close()
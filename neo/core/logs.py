@@ -0,0 +1,134 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import atexit
+import copy
+import json
+import logging
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+__all__ = ("ColouredFormatter", "JSONFormatter", "NonBlockingHandler", "setup_logging")
+
+# Attributes every LogRecord has, anything else was passed with `extra`
+RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class ColouredFormatter(logging.Formatter):
+    prefix = "\x1b[38;5;"
+    codes = {
+        "INFO": prefix + "2m",
+        "WARN": prefix + "100m",
+        "DEBUG": prefix + "26m",
+        "ERROR": prefix + "1m",
+        "WARNING": prefix + "220m",
+        "_RESET": "\x1b[0m",
+    }
+
+    def __init__(self):
+        super().__init__(
+            fmt="[{asctime} {levelname}/{name}] {message}",
+            datefmt="\x1b[38;2;132;206;255m%d/%m/%Y %H:%M:%S" + self.codes["_RESET"],
+            style="{",
+        )
+
+    def formatMessage(self, record):
+        # Colours a copy, so the record itself can still be handled elsewhere
+        if (code := self.codes.get(record.levelname)) is None:
+            return super().formatMessage(record)
+        reset = self.codes["_RESET"]
+        record = copy.copy(record)
+        record.levelname = code + record.levelname + reset
+        record.message = code + record.message + reset
+        return super().formatMessage(record)
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, including anything passed with `extra`"""
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exception"] = record.exc_text
+        if record.stack_info:
+            data["stack"] = self.formatStack(record.stack_info)
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        return json.dumps(data, default=str)
+
+
+class NonBlockingHandler(QueueHandler):
+    """Hands records to a `QueueListener` thread to be formatted and written.
+
+    Only the message's arguments are resolved on the calling thread, since
+    they may be mutated afterwards; tracebacks are formatted by the
+    listener. When the queue is full records are dropped rather than
+    blocking, and the number dropped is logged once there's room again."""
+
+    def __init__(self, queue_):
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(
+                    logging.makeLogRecord(
+                        {
+                            "name": __name__,
+                            "levelno": logging.WARNING,
+                            "levelname": "WARNING",
+                            "msg": f"Dropped {self.dropped} log records",
+                        }
+                    )
+                )
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(loggers, *, json_output=False, queue_size=10000):
+    """Routes each (name, level) logger through one background writer,
+    returning its listener"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JSONFormatter() if json_output else ColouredFormatter())
+    log_queue = queue.Queue(queue_size)
+    listener = QueueListener(log_queue, handler)
+    queue_handler = NonBlockingHandler(log_queue)
+    for name, level in loggers:
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.addHandler(queue_handler)
+    listener.start()
+    atexit.register(listener.stop)  # Flushes whatever's still queued
+    return listener
@@ -0,0 +1,224 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import logging
+import time
+from bisect import bisect_left
+from collections import Counter
+
+from functools import wraps
+
+from aiohttp import web
+
+__all__ = ("BUCKETS", "Histogram", "Metrics", "MetricsServer", "timed_listener")
+
+log = logging.getLogger(__name__)
+
+# Upper bounds in seconds, everything slower lands in the implicit +Inf bucket
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """A histogram over the fixed `BUCKETS`, so observing is a bisect and an
+    increment regardless of how many values have been seen"""
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """The upper bound of the bucket holding the `q` quantile"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip((*BUCKETS, float("inf")), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def cumulative(self):
+        seen = 0
+        for bound, count in zip((*BUCKETS, "+Inf"), self.counts):
+            seen += count
+            yield bound, seen
+
+
+class _Timer:
+    """Times a block. `key` may be reassigned inside of it, when what's being
+    timed is only known once it has started"""
+
+    __slots__ = ("metrics", "key", "entered", "start")
+
+    def __init__(self, metrics, key):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        self.entered = self.key
+        self.metrics.in_flight[self.entered] += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.key, time.perf_counter() - self.start)
+        self.metrics.in_flight[self.entered] -= 1
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            self.metrics.errors[self.key] += 1
+
+    def stop(self, *, failed=False):
+        """Ends a timer from `Metrics.start`"""
+        self.__exit__(Exception if failed else None, None, None)
+
+
+class Metrics:
+    """In-memory latency histograms, error counts and in-flight counts, each
+    keyed by (kind, name), e.g. ("command", "highlight add")"""
+
+    def __init__(self):
+        self.latency = {}
+        self.errors = Counter()
+        self.in_flight = Counter()
+        self.gauges = {}  # name -> callable returning {labels: value}
+
+    def observe(self, key, elapsed):
+        if (histogram := self.latency.get(key)) is None:
+            histogram = self.latency[key] = Histogram()
+        histogram.observe(elapsed)
+
+    def track(self, kind, name):
+        """A context manager timing whatever runs inside of it"""
+        return _Timer(self, (kind, name))
+
+    def start(self, kind, name):
+        """Starts timing something that ends elsewhere, e.g. in another hook,
+        returning a timer to `stop`"""
+        return self.track(kind, name).__enter__()
+
+    async def call(self, kind, name, func, *args, **kwargs):
+        """Awaits a coroutine function, tracking the call"""
+        with self.track(kind, name):
+            return await func(*args, **kwargs)
+
+    def add_gauge(self, name, callback):
+        """Adds a gauge computed at render time, `callback` returning a dict of
+        {((label, value), ...): reading}"""
+        self.gauges[name] = callback
+
+    def remove_gauge(self, name):
+        self.gauges.pop(name, None)
+
+    def slowest(self, kind=None, limit=10):
+        return sorted(
+            (
+                (key, histogram)
+                for key, histogram in self.latency.items()
+                if kind is None or key[0] == kind
+            ),
+            key=lambda item: item[1].quantile(0.99),
+            reverse=True,
+        )[:limit]
+
+    def to_prometheus(self):
+        """Renders everything in the Prometheus text exposition format"""
+
+        def labels(key, **extra):
+            pairs = {"kind": key[0], "name": key[1], **extra}
+            return ",".join(
+                '{0}="{1}"'.format(
+                    k, str(v).replace("\\", "\\\\").replace('"', '\\"')
+                )
+                for k, v in pairs.items()
+            )
+
+        lines = ["# TYPE neo_latency_seconds histogram"]
+        for key, histogram in self.latency.items():
+            for bound, seen in histogram.cumulative():
+                lines.append(
+                    f"neo_latency_seconds_bucket{{{labels(key, le=bound)}}} {seen}"
+                )
+            lines.append(f"neo_latency_seconds_sum{{{labels(key)}}} {histogram.total}")
+            lines.append(
+                f"neo_latency_seconds_count{{{labels(key)}}} {histogram.count}"
+            )
+        lines.append("# TYPE neo_errors_total counter")
+        for key, count in self.errors.items():
+            lines.append(f"neo_errors_total{{{labels(key)}}} {count}")
+        lines.append("# TYPE neo_in_flight gauge")
+        for key, count in self.in_flight.items():
+            lines.append(f"neo_in_flight{{{labels(key)}}} {count}")
+        for name, callback in self.gauges.items():
+            lines.append(f"# TYPE neo_{name} gauge")
+            for gauge_labels, value in callback().items():
+                rendered = ",".join(f'{k}="{v}"' for k, v in gauge_labels)
+                series = f"neo_{name}{{{rendered}}}" if rendered else f"neo_{name}"
+                lines.append(f"{series} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves `Metrics.to_prometheus` over HTTP for a local scraper"""
+
+    def __init__(self, metrics, *, host="127.0.0.1", port=9100):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle(self, request):
+        return web.Response(
+            text=self.metrics.to_prometheus(),
+            content_type="text/plain",
+            charset="utf-8",
+        )
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        log.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+def timed_listener(metrics, func):
+    """Wraps a listener so that its calls are tracked"""
+    name = getattr(func, "__qualname__", func.__name__)
+
+    @wraps(func)
+    async def timed(*args, **kwargs):
+        with metrics.track("listener", name):
+            return await func(*args, **kwargs)
+
+    return timed
@@ -0,0 +1,42 @@
+-- Changes made since schema.sql was first run. Every statement is idempotent,
+-- so this can be run against any database, old or new
+
+-- Regex highlights disabled for being too slow, see neo/utils/highlight_engine.py
+ALTER TABLE highlights ADD COLUMN IF NOT EXISTS disabled BOOLEAN DEFAULT FALSE;
+
+-- Tells every running bot which cached rows changed, see neo/core/sync.py
+-- The trigger's arguments are the key columns included in the notification
+CREATE OR REPLACE FUNCTION notify_cache_change() RETURNS trigger AS $$
+DECLARE
+        changed JSONB;
+        keys JSONB := '{}';
+        key_column TEXT;
+BEGIN
+        IF TG_OP = 'DELETE' THEN
+                changed := to_jsonb(OLD);
+        ELSE
+                changed := to_jsonb(NEW);
+        END IF;
+        FOREACH key_column IN ARRAY TG_ARGV LOOP
+                keys := keys || jsonb_build_object(key_column, changed -> key_column);
+        END LOOP;
+        PERFORM pg_notify(
+                'neo_cache',
+                json_build_object('table', TG_TABLE_NAME, 'op', TG_OP, 'keys', keys)::text
+        );
+        RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_data_cache ON user_data;
+CREATE TRIGGER user_data_cache AFTER INSERT OR UPDATE OR DELETE ON user_data
+        FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('user_id');
+DROP TRIGGER IF EXISTS guild_prefs_cache ON guild_prefs;
+CREATE TRIGGER guild_prefs_cache AFTER INSERT OR UPDATE OR DELETE ON guild_prefs
+        FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('guild_id');
+DROP TRIGGER IF EXISTS highlights_cache ON highlights;
+CREATE TRIGGER highlights_cache AFTER INSERT OR UPDATE OR DELETE ON highlights
+        FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('user_id');
+DROP TRIGGER IF EXISTS starboard_msgs_cache ON starboard_msgs;
+CREATE TRIGGER starboard_msgs_cache AFTER INSERT OR UPDATE OR DELETE ON starboard_msgs
+        FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('guild_id', 'message_id');
@@ -0,0 +1,139 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import logging
+import time
+
+__all__ = ("ProcessedMessage", "MessagePipeline")
+
+log = logging.getLogger(__name__)
+
+
+class ProcessedMessage:
+    """A message along with everything stages commonly look up about it,
+    which is worked out once per message"""
+
+    __slots__ = (
+        "message",
+        "content",
+        "guild_id",
+        "channel_id",
+        "author_id",
+        "author_bot",
+    )
+
+    def __init__(self, message):
+        self.message = message
+        self.content = message.content
+        self.guild_id = message.guild.id if message.guild else None
+        self.channel_id = message.channel.id
+        self.author_id = message.author.id
+        self.author_bot = message.author.bot
+
+    @property
+    def is_dm(self):
+        return self.guild_id is None
+
+
+class Stage:
+    __slots__ = (
+        "name",
+        "callback",
+        "when",
+        "bots",
+        "background",
+        "calls",
+        "skipped",
+        "failed",
+        "total",
+        "worst",
+    )
+
+    def __init__(self, name, callback, when, bots, background):
+        self.name = name
+        self.callback = callback
+        self.when = when
+        self.bots = bots
+        self.background = background
+        self.calls = 0
+        self.skipped = 0
+        self.failed = 0
+        self.total = 0.0
+        self.worst = 0.0
+
+    @property
+    def mean(self):
+        return self.total / self.calls if self.calls else 0.0
+
+    def accepts(self, processed):
+        if processed.author_bot and not self.bots:
+            return False
+        return self.when is None or self.when(processed)
+
+    async def run(self, processed):
+        start = time.perf_counter()
+        try:
+            await self.callback(processed)
+        except Exception as e:
+            self.failed += 1
+            log.error(f"Message stage {self.name!r} failed: {e!r}")
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.total += elapsed
+            if elapsed > self.worst:
+                self.worst = elapsed
+
+
+class MessagePipeline:
+    """Routes every message through the stages that want it.
+
+    Each message is normalised into a `ProcessedMessage` once, then each
+    stage's `when` predicate decides whether it runs, so skipping a stage
+    costs a function call rather than a listener task. Stages run in the
+    order they were added, except `background` stages, which are spawned
+    as tasks so that slow work (like invoking commands) doesn't hold up the
+    rest. Bot authors are only passed to stages that ask for `bots`."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.stages = {}
+        self._background = set()  # Held so that running tasks aren't collected
+
+    def add_stage(self, name, callback, *, when=None, bots=False, background=False):
+        self.stages[name] = Stage(name, callback, when, bots, background)
+
+    def remove_stage(self, name):
+        self.stages.pop(name, None)
+
+    def _background_done(self, task):
+        self._background.discard(task)
+        if not task.cancelled() and (exc := task.exception()) is not None:
+            log.error(f"Background message stage failed: {exc!r}")
+
+    async def process(self, message):
+        processed = ProcessedMessage(message)
+        for stage in [*self.stages.values()]:
+            if not stage.accepts(processed):
+                stage.skipped += 1
+            elif stage.background:
+                task = asyncio.ensure_future(stage.run(processed))
+                self._background.add(task)
+                task.add_done_callback(self._background_done)
+            else:
+                await stage.run(processed)
@@ -0,0 +1,73 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+__all__ = ("PrefixIndex",)
+
+DEFAULT_PREFIXES = ("n/",)
+
+
+class PrefixIndex:
+    """Precomputed prefix tuples for each guild, mentions included.
+
+    Writes to a guild's prefixes should `invalidate` it. Tuples are also
+    rebuilt when the guild's cached `prefixes` list is replaced, as a
+    fallback for writers that don't."""
+
+    def __init__(self, bot, default=DEFAULT_PREFIXES):
+        self.bot = bot
+        self.default = tuple(default)
+        self.guilds = {}  # guild_id -> (source list, prefix tuple)
+        self._mentions = None
+
+    @property
+    def mentions(self):
+        if self._mentions is None:
+            if self.bot.user is None:
+                return ()  # Not logged in yet, so don't cache anything
+            self._mentions = (f"<@{self.bot.user.id}> ", f"<@!{self.bot.user.id}> ")
+        return self._mentions
+
+    def get(self, guild_id):
+        if guild_id is None:
+            return self.mentions + self.default
+        row = self.bot.guild_cache.get(guild_id)
+        source = row["prefixes"] if row else None
+        cached = self.guilds.get(guild_id)
+        if cached is not None and cached[0] is source:
+            return cached[1]
+        if row is None:
+            prefixes = self.mentions + self.default
+        else:
+            # Longest first, so that the most specific prefix is the one invoked
+            custom = sorted({*(source or ())}, key=len, reverse=True)
+            prefixes = self.mentions + tuple(custom)
+        if self.mentions:
+            self.guilds[guild_id] = (source, prefixes)
+        return prefixes
+
+    def for_message(self, message):
+        return self.get(message.guild.id if message.guild else None)
+
+    def matches(self, message):
+        """Whether a message starts with a prefix, so it could be a command"""
+        return message.content.startswith(self.for_message(message))
+
+    def invalidate(self, guild_id=None):
+        if guild_id is None:
+            self.guilds.clear()
+        else:
+            self.guilds.pop(guild_id, None)
@@ -0,0 +1,137 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import sys
+import time
+from array import array
+
+from discord.ext import commands
+
+__all__ = ("RateLimiter", "rate_cost", "get_rate_cost")
+
+
+def rate_cost(amount):
+    """Makes a command use up `amount` of the global ratelimit instead of 1"""
+
+    def decorator(func):
+        target = func.callback if isinstance(func, commands.Command) else func
+        target.__rate_cost__ = amount
+        return func
+
+    return decorator
+
+
+def get_rate_cost(command):
+    return getattr(command.callback, "__rate_cost__", 1)
+
+
+class RateLimiter:
+    """Token buckets for any number of keys, such as user IDs.
+
+    Rather than an object per key, each bucket is a slot in two arrays of
+    doubles, with a dict mapping keys to slots. A bucket that has been idle
+    long enough to refill is no different from a new one, so sweeps drop
+    those keys and reuse their slots. Sweeps run every `sweep_interval`
+    seconds as part of `hit`, rather than in a task."""
+
+    def __init__(self, rate, per, *, capacity=None, sweep_interval=60.0):
+        self.rate = rate
+        self.per = per
+        self.capacity = float(rate if capacity is None else capacity)
+        self.refill = rate / per  # Tokens per second
+        self.sweep_interval = sweep_interval
+        self.slots = {}
+        self.tokens = array("d")
+        self.updated = array("d")
+        self.free = []
+        self.last_sweep = time.monotonic()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __repr__(self):
+        return "<{0.__class__.__name__} rate={0.rate} per={0.per} keys={1}>".format(
+            self, len(self)
+        )
+
+    @property
+    def memory(self):
+        """Bytes used by the buckets, not counting the keys themselves"""
+        return sum(
+            map(sys.getsizeof, (self.slots, self.tokens, self.updated, self.free))
+        )
+
+    def _current(self, slot, now):
+        return min(
+            self.capacity, self.tokens[slot] + (now - self.updated[slot]) * self.refill
+        )
+
+    def remaining(self, key, now=None):
+        if (slot := self.slots.get(key)) is None:
+            return self.capacity
+        return self._current(slot, time.monotonic() if now is None else now)
+
+    def hit(self, key, cost=1, now=None):
+        """Takes `cost` tokens from the key's bucket. Returns 0 if there were
+        enough, otherwise how many seconds until there will be.
+
+        Costs over the capacity are capped, so they need a full bucket."""
+        now = time.monotonic() if now is None else now
+        if now - self.last_sweep >= self.sweep_interval:
+            self.sweep(now)
+        cost = min(cost, self.capacity)
+        if (slot := self.slots.get(key)) is None:
+            if self.free:
+                slot = self.free.pop()
+                self.tokens[slot] = self.capacity
+                self.updated[slot] = now
+            else:
+                slot = len(self.tokens)
+                self.tokens.append(self.capacity)
+                self.updated.append(now)
+            self.slots[key] = slot
+        tokens = self._current(slot, now)
+        self.updated[slot] = now
+        if tokens < cost:
+            self.tokens[slot] = tokens
+            return (cost - tokens) / self.refill
+        self.tokens[slot] = tokens - cost
+        return 0.0
+
+    def sweep(self, now=None):
+        """Forgets keys whose buckets have refilled, returning how many"""
+        now = time.monotonic() if now is None else now
+        self.last_sweep = now
+        idle = [
+            key
+            for key, slot in self.slots.items()
+            if self._current(slot, now) >= self.capacity
+        ]
+        for key in idle:
+            self.free.append(self.slots.pop(key))
+        if len(self.free) > len(self.slots):
+            self._compact()
+        return len(idle)
+
+    def _compact(self):
+        # Dicts and arrays never shrink on their own, so rebuild them
+        slots, tokens, updated = {}, array("d"), array("d")
+        for key, slot in self.slots.items():
+            slots[key] = len(tokens)
+            tokens.append(self.tokens[slot])
+            updated.append(self.updated[slot])
+        self.slots, self.tokens, self.updated, self.free = slots, tokens, updated, []
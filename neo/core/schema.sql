@@ -14,6 +14,7 @@ CREATE TABLE highlights (
     user_id BIGINT NOT NULL,
     kw TEXT NOT NULL,
     is_regex BOOLEAN DEFAULT TRUE,
+    disabled BOOLEAN DEFAULT FALSE,
     PRIMARY KEY(user_id, kw, is_regex)
 );
 
@@ -61,4 +62,7 @@ BEGIN
         SET starboard_channel_id = new_destination
         WHERE guild_prefs.guild_id = _guild_id;
 END;
-$$ LANGUAGE plpgsql;
\ No newline at end of file
+$$ LANGUAGE plpgsql;
+
+-- Then run migrations.sql, which brings an existing database up to date and
+-- is safe to run again on every deploy
@@ -0,0 +1,143 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import json
+import logging
+
+import asyncpg
+import neo
+
+__all__ = ("CacheSync",)
+
+log = logging.getLogger(__name__)
+
+CHANNEL = "neo_cache"  # Must match notify_cache_change in migrations.sql
+HEARTBEAT = 30.0
+MAX_BACKOFF = 60.0
+
+
+class CacheSync:
+    """Keeps caches coherent when the database is written to by other processes.
+
+    Triggers on the cached tables NOTIFY the changed table, operation and key
+    columns, which a dedicated connection LISTENs for. `user_cache` and
+    `guild_cache` are reloaded here, then a `db_change` event is dispatched
+    so that cogs can patch their own caches. Changes made through this
+    process's pool are skipped, since they've already been applied.
+
+    Changes are applied one at a time in the order they were received, so an
+    older change can't land after a newer one. Notifications sent while the
+    listener isn't connected are lost, so every time it starts listening,
+    including the first, is followed by a full resync and a `db_resync`
+    event."""
+
+    def __init__(self, bot, *, channel=CHANNEL):
+        self.bot = bot
+        self.channel = channel
+        self.own_pids = set()
+        self.connection = None
+        self.task = None
+        self.changes = asyncio.Queue()
+        self.applier = None
+
+    async def register(self, connection):
+        """Pool `init` hook, which records the backend of each pooled connection
+        for as long as the connection lives"""
+        pid = connection.get_server_pid()
+        self.own_pids.add(pid)
+        # Once closed, the pid may be reused by another process's backend
+        connection.add_termination_listener(lambda _: self.own_pids.discard(pid))
+
+    def start(self):
+        self.task = self.bot.loop.create_task(self.run())
+        self.applier = self.bot.loop.create_task(self.apply_changes())
+
+    async def stop(self):
+        for task in (self.task, self.applier):
+            if task is not None:
+                task.cancel()
+        if self.connection is not None:
+            await self.connection.close()
+
+    async def run(self):
+        backoff = 1.0
+        while not self.bot.is_closed():
+            try:
+                self.connection = await asyncpg.connect(**neo.secrets.database)
+                await self.connection.add_listener(self.channel, self.on_notify)
+                log.info(f"Listening for cache changes on {self.channel!r}")
+                # Anything written before now, including between the initial
+                # cache loads and listening, was missed
+                await self.resync()
+                backoff = 1.0
+                while not self.connection.is_closed():
+                    await asyncio.sleep(HEARTBEAT)
+                    await self.connection.fetchval("SELECT 1", timeout=HEARTBEAT)
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+                log.warning(f"Cache change listener disconnected: {e!r}")
+            except Exception as e:
+                log.error(f"Cache change listener failed: {e!r}")
+            finally:
+                if self.connection is not None and not self.connection.is_closed():
+                    self.connection.terminate()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def on_notify(self, connection, pid, channel, payload):
+        if pid in self.own_pids:
+            return
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            log.warning(f"Ignoring malformed cache change {payload!r}")
+            return
+        self.changes.put_nowait((change["table"], change["op"], change["keys"]))
+
+    async def apply_changes(self):
+        while True:
+            change = await self.changes.get()
+            try:
+                await self.apply(*change)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception(f"Couldn't apply cache change {change!r}")
+
+    async def apply(self, table, op, keys):
+        caches = {
+            "user_data": (self.bot.user_cache, "user_id"),
+            "guild_prefs": (self.bot.guild_cache, "guild_id"),
+        }
+        if table in caches:
+            cache, key = caches[table]
+            if op == "DELETE":
+                cache.evict(keys[key])
+            else:
+                await cache.reload(keys[key])
+            if table == "guild_prefs":
+                self.bot.prefixes.invalidate(keys[key])
+        self.bot.dispatch("db_change", table, op, keys)
+
+    async def resync(self):
+        log.info("Resyncing caches now that changes are being listened for")
+        await self.bot.user_cache.refresh()
+        await self.bot.guild_cache.refresh()
+        self.bot.prefixes.invalidate()
+        self.bot.dispatch("db_resync")
@@ -0,0 +1,221 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import re
+import time
+from collections import Counter
+
+import aiohttp
+
+from .metrics import Histogram
+
+__all__ = ("IOEntry", "IOStats", "TracedPool", "trace_config")
+
+OVERFLOW = "<other>"  # Name that everything past `max_entries` is recorded under
+
+
+class IOEntry:
+    """Aggregated timings for one HTTP host or one SQL query.
+
+    `volume` is bytes received for HTTP and rows returned for SQL, and
+    `wait` is time spent getting a connection: queueing for and opening
+    one for HTTP, acquiring one from the pool for SQL."""
+
+    __slots__ = ("latency", "errors", "volume", "wait", "reused", "statuses")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.volume = 0
+        self.wait = 0.0
+        self.reused = 0
+        self.statuses = Counter()
+
+    @property
+    def count(self):
+        return self.latency.count
+
+    @property
+    def mean_wait(self):
+        return self.wait / self.count if self.count else 0.0
+
+
+class IOStats:
+    """Queryable store of outbound I/O, keyed by ("http", host) or
+    ("sql", query text).
+
+    Queries built with string formatting would make a new entry each, so
+    past `max_entries` new names are folded into one `<other>` entry."""
+
+    sorts = {
+        "p99": lambda entry: entry.latency.quantile(0.99),
+        "mean": lambda entry: entry.latency.mean,
+        "total": lambda entry: entry.latency.total,
+        "count": lambda entry: entry.count,
+        "wait": lambda entry: entry.mean_wait,
+        "errors": lambda entry: entry.errors,
+    }
+
+    def __init__(self, *, max_entries=500):
+        self.max_entries = max_entries
+        self.entries = {}
+
+    def entry(self, kind, name):
+        key = (kind, name)
+        if (entry := self.entries.get(key)) is None:
+            if len(self.entries) >= self.max_entries:
+                key = (kind, OVERFLOW)
+                if (entry := self.entries.get(key)) is not None:
+                    return entry
+            entry = self.entries[key] = IOEntry()
+        return entry
+
+    def query(self, kind=None, *, contains=None, sort="p99", limit=15):
+        """The top `limit` entries by `sort`, optionally filtered by kind and
+        by a case insensitive substring of the name"""
+        if sort not in self.sorts:
+            options = ", ".join(self.sorts)
+            raise ValueError(f"Can't sort by {sort!r}, use one of {options}")
+        contains = contains.lower() if contains else None
+        matches = [
+            (key, entry)
+            for key, entry in self.entries.items()
+            if (kind is None or key[0] == kind)
+            and (contains is None or contains in key[1].lower())
+        ]
+        matches.sort(key=lambda item: self.sorts[sort](item[1]), reverse=True)
+        return matches[:limit]
+
+    def reset(self):
+        self.entries.clear()
+
+
+def trace_config(stats):
+    """An aiohttp TraceConfig recording every request made by the session
+    into `stats`, by host"""
+    config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params):
+        context.host = params.url.host or str(params.url)
+        context.start = time.perf_counter()
+        context.wait = 0.0
+        context.reused = False
+
+    async def on_wait_start(session, context, params):
+        context.wait_start = time.perf_counter()
+
+    async def on_wait_end(session, context, params):
+        context.wait += time.perf_counter() - context.wait_start
+
+    async def on_connection_reuseconn(session, context, params):
+        context.reused = True
+
+    async def on_response_chunk_received(session, context, params):
+        # Bodies are read after on_request_end, so this goes straight to the entry
+        stats.entry("http", context.host).volume += len(params.chunk)
+
+    def finish(context, status):
+        entry = stats.entry("http", context.host)
+        entry.latency.observe(time.perf_counter() - context.start)
+        entry.wait += context.wait
+        entry.reused += context.reused
+        entry.statuses[status] += 1
+        return entry
+
+    async def on_request_end(session, context, params):
+        # Only covers the headers, the body's bytes are counted as it's read
+        finish(context, params.response.status)
+
+    async def on_request_exception(session, context, params):
+        finish(context, type(params.exception).__name__).errors += 1
+
+    config.on_request_start.append(on_request_start)
+    config.on_connection_queued_start.append(on_wait_start)
+    config.on_connection_queued_end.append(on_wait_end)
+    config.on_connection_create_start.append(on_wait_start)
+    config.on_connection_create_end.append(on_wait_end)
+    config.on_connection_reuseconn.append(on_connection_reuseconn)
+    config.on_response_chunk_received.append(on_response_chunk_received)
+    config.on_request_end.append(on_request_end)
+    config.on_request_exception.append(on_request_exception)
+    return config
+
+
+def _rows(method, result):
+    if method in ("fetch", "executemany"):
+        return len(result) if result else 0
+    if method == "execute":
+        # The command tag, e.g. "UPDATE 3"
+        count = result.rpartition(" ")[2]
+        return int(count) if count.isdigit() else 0
+    return result is not None
+
+
+class TracedPool:
+    """Wraps an asyncpg pool so that each query is recorded into `stats`,
+    by its text, along with how long acquiring a connection took.
+
+    Anything other than the query methods is passed through to the pool,
+    so this can stand in for it everywhere."""
+
+    _whitespace = re.compile(r"\s+")
+
+    def __init__(self, pool, stats):
+        self._pool = pool
+        self.stats = stats
+        self._names = {}  # query text -> normalised name
+
+    def __getattr__(self, attr):
+        return getattr(self._pool, attr)
+
+    def _name(self, query):
+        if (name := self._names.get(query)) is None:
+            name = self._whitespace.sub(" ", query).strip()
+            if len(self._names) < self.stats.max_entries:
+                self._names[query] = name
+        return name
+
+    async def _run(self, method, query, args, kwargs):
+        start = time.perf_counter()
+        async with self._pool.acquire() as connection:
+            acquired = time.perf_counter()
+            entry = self.stats.entry("sql", self._name(query))
+            entry.wait += acquired - start
+            try:
+                result = await getattr(connection, method)(query, *args, **kwargs)
+            except BaseException:
+                entry.errors += 1
+                raise
+            finally:
+                entry.latency.observe(time.perf_counter() - acquired)
+        entry.volume += _rows(method, result)
+        return result
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._run("execute", query, args, kwargs)
+
+    async def executemany(self, query, args, **kwargs):
+        return await self._run("executemany", query, (args,), kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._run("fetch", query, args, kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._run("fetchrow", query, args, kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._run("fetchval", query, args, kwargs)
@@ -32,6 +32,7 @@ import neo
 import neo.utils.errors as errors
 from discord.ext import commands, flags
 from neo.utils.paginator import CSMenu, PagedEmbedMenu
+from neo.core.ratelimit import rate_cost
 
 
 def filter_posts(obj):
@@ -126,6 +127,7 @@ class Api(commands.Cog):
         )
         await ctx.send(embed=embed)
 
+    @rate_cost(2)
     @commands.group(aliases=["tr"], invoke_without_command=True)
     async def translate(self, ctx, *, content):
         """
@@ -133,6 +135,7 @@ class Api(commands.Cog):
         """
         await self.do_translation(ctx, content)
 
+    @rate_cost(2)
     @translate.command(name="to")
     async def translate_to(self, ctx, destination_language: str, *, content):
         """
@@ -140,6 +143,7 @@ class Api(commands.Cog):
         """
         await self.do_translation(ctx, content, destination_language)
 
+    @rate_cost(2)
     @commands.group(invoke_without_command=True, aliases=["g"])
     async def google(self, ctx, *, query: str):
         """
@@ -191,12 +195,14 @@ class Api(commands.Cog):
 
     @flags.add_flag("-ss", "--safesearch", action="store_true")
     @flags.add_flag("query", nargs="*")
+    @rate_cost(2)
     @google.command(aliases=["img", "i"], cls=flags.FlagCommand)
     async def _google_image(self, ctx, **flags):
         await self.image_callback(ctx, **flags)
 
     @flags.add_flag("-ss", "--safesearch", action="store_true")
     @flags.add_flag("query", nargs="*")
+    @rate_cost(2)
     @commands.command(aliases=["img", "i"], cls=flags.FlagCommand)
     async def _just_fucking_image(self, ctx, **flags):
         await self.image_callback(ctx, **flags)
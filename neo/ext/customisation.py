@@ -60,7 +60,8 @@ class Reminder:
                 "DELETE FROM reminders WHERE id=$1", self.rm_id
             )
 
-        if self.bot.user_cache[self.user.id].get("dm_reminders", False) is True:
+        settings = await self.bot.user_cache.fetch(self.user.id) or {}
+        if settings.get("dm_reminders", False) is True:
             target = self.user
 
         original_reference = discord.PartialMessage(
@@ -110,12 +111,13 @@ class Customisation(commands.Cog):
                     f"New setting must be one of {', '.join(keys)}"
                 )
             async with ctx.loading():
-                await self.bot.pool.execute(
-                    f"UPDATE user_data SET {setting_name}=$1 WHERE user_id=$2",
+                row = await self.bot.pool.fetchrow(
+                    f"UPDATE user_data SET {setting_name}=$1 WHERE user_id=$2 "
+                    "RETURNING *",
                     new_setting,
                     ctx.author.id,
                 )
-            await self.bot.user_cache.refresh()
+            self.bot.user_cache.upsert(ctx.author.id, row)
             return
         embed = discord.Embed(title=f"""{ctx.author}'s Settings""")
         readable_settings = []
@@ -151,12 +153,13 @@ class Customisation(commands.Cog):
                     f"New setting must be one of {', '.join(keys)}"
                 )
             async with ctx.loading():
-                await self.bot.pool.execute(
-                    f"UPDATE guild_prefs SET {setting_name}=$1 WHERE guild_id=$2",
+                row = await self.bot.pool.fetchrow(
+                    f"UPDATE guild_prefs SET {setting_name}=$1 WHERE guild_id=$2 "
+                    "RETURNING *",
                     new_setting,
                     ctx.guild.id,
                 )
-            await self.bot.guild_cache.refresh()
+            self.bot.guild_cache.upsert(ctx.guild.id, row)
             return
         embed = discord.Embed(title=f"""{ctx.guild}'s Settings""")
         readable_settings = []
@@ -207,12 +210,13 @@ class Customisation(commands.Cog):
             if strat == current_prefixes.add and len(current_prefixes) == 5:
                 raise commands.CommandError("A guild may have no more than 5 prefixes")
             strat(prefix)
-            await self.bot.pool.execute(
-                "UPDATE guild_prefs SET prefixes=$1 WHERE guild_id=$2",
+            row = await self.bot.pool.fetchrow(
+                "UPDATE guild_prefs SET prefixes=$1 WHERE guild_id=$2 RETURNING *",
                 current_prefixes,
                 ctx.guild.id,
             )
-            await self.bot.guild_cache.refresh()
+            self.bot.guild_cache.upsert(ctx.guild.id, row)
+            self.bot.prefixes.invalidate(ctx.guild.id)
 
     @commands.group(aliases=["hl"], invoke_without_command=True, ignore_extra=False)
     async def highlight(self, ctx):
@@ -227,11 +231,7 @@ class Customisation(commands.Cog):
                 return f"`{index}` <:regex:735370786294202480> `{kw_full}`"
             return f"`{index}` `{kw_full}`"
 
-        my_hl = list(
-            filter(
-                lambda hl: hl.user_id == ctx.author.id, self.bot.get_cog("HlMon").cache
-            )
-        )
+        my_hl = self.bot.get_cog("HlMon").cache.get(ctx.author.id, [])
         await ctx.send(
             embed=discord.Embed(
                 description="\n".join(map(format_hl, enumerate(my_hl, 1)))
@@ -257,6 +257,104 @@ class Dev(commands.Cog):
         new_ctx = await copy_ctx(ctx, f"eval return inspect!.getsource({obj})")
         await new_ctx.reinvoke()
 
+    @dev_command_group.command(name="stats")
+    async def _dev_stats(self, ctx, kind=None):
+        """View the slowest commands, listeners, checks, etc"""
+        metrics = self.bot.metrics
+        rows = [
+            [
+                f"{key[0]} {key[1]}"[:32],
+                histogram.count,
+                f"{histogram.mean * 1000:.1f}",
+                f"{histogram.quantile(0.5) * 1000:g}",
+                f"{histogram.quantile(0.99) * 1000:g}",
+                metrics.errors[key],
+                metrics.in_flight[key],
+            ]
+            for key, histogram in metrics.slowest(kind, 15)
+        ]
+        headers = ["name", "n", "mean", "p50", "p99", "err", "now"]
+        table = tabulate(rows, headers=headers)
+        stages = tabulate(
+            [
+                [
+                    stage.name,
+                    stage.calls,
+                    stage.skipped,
+                    stage.failed,
+                    f"{stage.mean * 1000:.2f}",
+                    f"{stage.worst * 1000:.1f}",
+                ]
+                for stage in self.bot.pipeline.stages.values()
+            ],
+            headers=["stage", "n", "skipped", "failed", "mean", "worst"],
+        )
+        limiter = self.bot.ratelimiter
+        caches = ", ".join(
+            f"{k}={v}" for k, v in sorted(self.bot.user_cache.stats.items())
+        )
+        footer = (
+            f"ratelimit: {len(limiter)} keys, {limiter.memory / 1024:.1f}KiB\n"
+            f"user_cache: {len(self.bot.user_cache)} rows, {caches or 'no stats'}"
+        )
+        if (starboard := self.bot.get_cog("Starboard")) is not None:
+            readiness = starboard.readiness()
+            footer += "\nstarboards: " + ", ".join(
+                f"{len(guilds)} {state}" for state, guilds in readiness.items()
+            )
+            if pending := readiness["loading"] | readiness["waiting"]:
+                footer += f" (not loaded: {', '.join(map(str, sorted(pending)[:5]))}"
+                footer += f", +{len(pending) - 5} more)" if len(pending) > 5 else ")"
+        content = f"{table or 'No data'}\n\n{stages}\n\n{footer}"
+        pages = [str(ctx.codeblock(content=page)) for page in group(content, 1500)]
+        await ctx.paginate(
+            pages,
+            1,
+            delete_on_button=True,
+            clear_reactions_after=True,
+            timeout=300,
+            template=discord.Embed().set_author(name="Times in ms"),
+        )
+
+    @dev_command_group.command(name="io")
+    async def _dev_io(self, ctx, kind=None, sort="p99", *, contains=None):
+        """View the slowest HTTP hosts and SQL queries
+
+        `kind` is http, sql or all, and `sort` is one of p99, mean,
+        total, count, wait or errors"""
+        try:
+            entries = self.bot.io_stats.query(
+                None if kind in (None, "all") else kind,
+                contains=contains,
+                sort=sort,
+                limit=25,
+            )
+        except ValueError as e:
+            raise commands.BadArgument(str(e))
+        rows = [
+            [
+                f"{key[0]} {key[1]}"[:40],
+                entry.count,
+                f"{entry.latency.mean * 1000:.1f}",
+                f"{entry.latency.quantile(0.99) * 1000:g}",
+                f"{entry.mean_wait * 1000:.2f}",
+                entry.volume,
+                entry.errors,
+            ]
+            for key, entry in entries
+        ]
+        headers = ["name", "n", "mean", "p99", "wait", "rows/bytes", "err"]
+        table = tabulate(rows, headers=headers) or "No data"
+        pages = [str(ctx.codeblock(content=page)) for page in group(table, 1500)]
+        await ctx.paginate(
+            pages,
+            1,
+            delete_on_button=True,
+            clear_reactions_after=True,
+            timeout=300,
+            template=discord.Embed().set_author(name="Times in ms"),
+        )
+
     @dev_command_group.command(name="journalctl", aliases=["jctl"])
     async def _dev_journalctl(self, ctx):
         new_ctx = await copy_ctx(ctx, f"sh sudo journalctl -u neo -o cat")
@@ -358,7 +456,7 @@ class Dev(commands.Cog):
             raise commands.CommandError("What the fuck no you don't get to do that")
 
         async with ctx.loading():
-            if not (_u := self.bot.user_cache.get(target)):
+            if not (_u := await self.bot.user_cache.fetch(target)):
                 with suppress(Exception):
                     await self.bot.pool.execute(
                         "INSERT INTO user_data (user_id) VALUES ($1)", target
@@ -366,12 +464,12 @@ class Dev(commands.Cog):
                 _blacklisted = False
             else:
                 _blacklisted = _u["_blacklisted"]
-            await self.bot.pool.execute(
-                "UPDATE user_data SET _blacklisted=$1 WHERE user_id=$2",
+            row = await self.bot.pool.fetchrow(
+                "UPDATE user_data SET _blacklisted=$1 WHERE user_id=$2 RETURNING *",
                 not _blacklisted,
                 target,
             )
-            await self.bot.user_cache.refresh()
+            self.bot.user_cache.upsert(target, row)
 
 
 def setup(bot):
@@ -88,7 +88,7 @@ class Events(commands.Cog):
 
         do_emojis = True
         error = getattr(error, "original", error)
-        if (settings := self.bot.user_cache.get(ctx.author.id)):
+        if (settings := await self.bot.user_cache.fetch(ctx.author.id)):
             if settings.get("repr_errors"):
                 error = repr(error)
             do_emojis = settings.get("error_emojis", True)
@@ -118,7 +118,7 @@ class Events(commands.Cog):
                 "deleted": collections.deque(list(), 100),
                 "edited": collections.deque(list(), 100),
             }
-        if usr := self.bot.user_cache.get(after.author.id):
+        if usr := await self.bot.user_cache.fetch(after.author.id):
             if not usr["can_snipe"]:
                 return
         if after.content and not after.author.bot:  # Updates the snipes edit cache
@@ -149,7 +149,7 @@ class Events(commands.Cog):
                 "deleted": collections.deque(list(), 100),
                 "edited": collections.deque(list(), 100),
             }
-        if usr := self.bot.user_cache.get(message.author.id):
+        if usr := await self.bot.user_cache.fetch(message.author.id):
             if not usr["can_snipe"]:
                 return
         if (
@@ -181,13 +181,13 @@ class Events(commands.Cog):
                     break
             embed.add_field(name="**Added By**", value=action.user)
 
-        await self.bot.pool.execute(  # Adds/updates this guild in the db using upsert syntax
+        row = await self.bot.pool.fetchrow(  # Adds/updates this guild in the db using upsert syntax
             "INSERT INTO guild_prefs (guild_id, prefixes) VALUES ($1, $2)"
-            "ON CONFLICT (guild_id) DO UPDATE SET prefixes=$2",
+            "ON CONFLICT (guild_id) DO UPDATE SET prefixes=$2 RETURNING *",
             guild.id,
             ["n/"],
         )
-        await self.bot.guild_cache.refresh()
+        self.bot.guild_cache.upsert(guild.id, row)
         await self.bot.logging_channels.get("guild_io").send(embed=embed)
 
     @commands.Cog.listener()
@@ -201,7 +201,7 @@ class Events(commands.Cog):
             color=discord.Color.pornhub,
         )  # Don't ask
         embed.set_thumbnail(url=guild.icon_url_as(static_format="png"))
-        await self.bot.guild_cache.refresh()
+        self.bot.guild_cache.evict(guild.id)
         await self.bot.logging_channels.get("guild_io").send(embed=embed)
 
     @tasks.loop(seconds=300)
@@ -30,6 +30,7 @@ import uwuify
 from async_timeout import timeout
 from discord.ext import commands
 from humanize import apnumber
+from neo.core.ratelimit import rate_cost
 from PIL import Image, ImageSequence
 
 NUM_EMOJIS = {str(num): f":{apnumber(num)}:" for num in range(10)}
@@ -143,6 +144,7 @@ class Fun(commands.Cog):
     async def get_emoji(self, ctx, *, emoji):
         ...
 
+    @rate_cost(2)
     @commands.max_concurrency(1, commands.BucketType.channel)
     @get_emoji.command()
     async def big(self, ctx, emoji: discord.PartialEmoji):
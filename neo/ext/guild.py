@@ -44,19 +44,33 @@ class Guild(commands.Cog):
         self.bot = bot
         self._counting_cache = collections.defaultdict(dict)
         self._cache_ready = False
+        self._dirty = set()  # Guilds counted in since their number was last pushed
         self.locks = {}
         bot.loop.create_task(self.get_cache())
+        bot.pipeline.add_stage(
+            "counting",
+            lambda processed: self.check_counting(processed.message),
+            when=self.is_counting_message,
+            bots=True,  # Bots can't count either
+        )
 
     async def get_cache(self):
         await self.bot.wait_until_ready()
-        for record in await self.bot.pool.fetch(
+        records = await self.bot.pool.fetch(
             "SELECT guild_id, counting_channel FROM guild_prefs"
-        ):
-            _id, counting = record
+        )
+        # Built aside and swapped in without awaiting, so counting is never
+        # checked against a partial cache
+        cache = collections.defaultdict(dict)
+        for _id, counting in records:
             if not counting:
                 continue
-            self._counting_cache[_id] = dict(counting)
-            self.locks[_id] = asyncio.Lock()
+            counting = cache[_id] = dict(counting)
+            if _id in self._dirty and _id in self._counting_cache:
+                # The number counted up to here is newer than the pushed one
+                counting["current_number"] = self._counting_cache[_id]["current_number"]
+            self.locks.setdefault(_id, asyncio.Lock())
+        self._counting_cache = cache
         if not self._cache_ready:
             self.push_counting_data.start()
             self._cache_ready = True
@@ -64,6 +78,28 @@ class Guild(commands.Cog):
     def cog_check(self, ctx):
         return bool(ctx.guild)
 
+    @commands.Cog.listener(name="on_db_change")
+    async def sync_counting(self, table, op, keys):
+        if table != "guild_prefs":
+            return
+        guild_id = keys["guild_id"]
+        # guild_cache has already been reloaded by the time this is dispatched
+        settings = self.bot.guild_cache.get(guild_id) or {}
+        if not (counting := settings.get("counting_channel")):
+            self._counting_cache.pop(guild_id, None)
+            return
+        current = self._counting_cache.get(guild_id)
+        if current is not None and guild_id in self._dirty:
+            # Only take the channel, the number counted up to here is newer
+            current["channel_id"] = counting["channel_id"]
+        else:
+            self._counting_cache[guild_id] = dict(counting)
+        self.locks.setdefault(guild_id, asyncio.Lock())
+
+    @commands.Cog.listener(name="on_db_resync")
+    async def resync_counting(self):
+        await self.get_cache()
+
     @flags.add_flag("search_depth", type=int, nargs="?", default=5)
     @flags.add_flag("--user", nargs="+")
     @flags.add_flag("--contains", nargs="+")
@@ -185,6 +221,7 @@ class Guild(commands.Cog):
         if self._counting_cache.get(ctx.guild.id) is None:
             return await ctx.send("You must first set up a channel!")
 
+        self._dirty.discard(ctx.guild.id)  # The override wins over unpushed counts
         await self.bot.pool.execute(
             "UPDATE guild_prefs SET counting_channel.current_number=$1 WHERE guild_id=$2",
             number,
@@ -194,14 +231,11 @@ class Guild(commands.Cog):
 
         await ctx.message.add_reaction(ctx.tick(True))
 
-    @commands.Cog.listener(name="on_message")
+    def is_counting_message(self, processed):
+        counting = self._counting_cache.get(processed.guild_id)
+        return bool(counting) and counting["channel_id"] == processed.channel_id
+
     async def check_counting(self, msg):
-        if not msg.guild:
-            return
-        elif not self._counting_cache.get(msg.guild.id):
-            return
-        elif self._counting_cache[msg.guild.id]["channel_id"] != msg.channel.id:
-            return
         lock = self.locks[msg.guild.id]
         try:
             if lock.locked():
@@ -211,6 +245,7 @@ class Guild(commands.Cog):
                 cur = self._counting_cache[msg.guild.id]["current_number"]
                 if new == (cur + 1):
                     self._counting_cache[msg.guild.id]["current_number"] = new
+                    self._dirty.add(msg.guild.id)
                     return
                 else:
                     raise ValueError()
@@ -233,31 +268,36 @@ class Guild(commands.Cog):
             original_value = int(before.content)
             if current_value == original_value:
                 self._counting_cache[after.guild.id]["current_number"] -= 1
-
-    @tasks.loop(seconds=300)
-    async def push_counting_data(self):
-        for _id, data in self._counting_cache.items():
+                self._dirty.add(after.guild.id)
+
+    async def push_counted(self):
+        # Only guilds counted in here, so that processes which aren't serving a
+        # guild don't push their stale copy of its number over the live one
+        for _id in [*self._dirty]:
+            self._dirty.discard(_id)
+            if not (data := self._counting_cache.get(_id)):
+                continue
             await self.bot.pool.execute(
                 "UPDATE guild_prefs SET counting_channel=$1::counting WHERE guild_id=$2",
                 data,
                 _id,
             )
 
+    @tasks.loop(seconds=300)
+    async def push_counting_data(self):
+        await self.push_counted()
+
     @push_counting_data.before_loop
     async def wait_for_ready(self):
         await self.bot.wait_until_ready()
 
     @push_counting_data.after_loop
     async def push_final_data(self):
-        for _id, data in self._counting_cache.items():
-            await self.bot.pool.execute(
-                "UPDATE guild_prefs SET counting_channel=$1::counting WHERE guild_id=$2",
-                data,
-                _id,
-            )
+        await self.push_counted()
 
     def cog_unload(self):
         self.push_counting_data.cancel()
+        self.bot.pipeline.remove_stage("counting")
 
 
 def setup(bot):
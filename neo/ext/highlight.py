@@ -16,21 +16,35 @@ You should have received a copy of the GNU Affero General Public License
 along with neo.  If not, see <https://www.gnu.org/licenses/>.
 """
 import asyncio
+import logging
 import re
-from collections import namedtuple
-from contextlib import suppress
+import time
+from collections import Counter, deque, namedtuple
 from textwrap import shorten
 
 import discord
 import neo
 from discord.ext import commands, flags, tasks
 from neo.types import TimedSet
+from neo.utils.highlight_engine import (REGEX_BUDGET, BaseHighlight,
+                                        HighlightIndex, HighlightMatcher,
+                                        MatchUnit, MatchWorkerPool,
+                                        compile_pattern)
+
+log = logging.getLogger(__name__)
 
 # Constants
 MAX_HIGHLIGHTS = 10
-PendingHighlight = namedtuple("PendingHighlight", ["user", "embed", "text"])
+CONTEXT_SIZE = 5
+MAX_PENDING = 1000  # Highlights waiting for delivery across all users
+MAX_PENDING_PER_USER = 10
+EMBED_LIMIT = 6000  # Total characters Discord allows across an embed
+DELIVERY_CONCURRENCY = 4
+DM_RATE = (5, 1.0)  # DMs per seconds, well under the global limit
+PendingHighlight = namedtuple("PendingHighlight", ["user", "context", "match", "text"])
 
 regex_flag = re.compile(r"--?re(gex)?")
+guild_flag = re.compile(r"(?<!\S)--guild\b")
 excessive_or = re.compile(r"(?<!\\)\|")
 excessive_escapes = re.compile(r"(?<!\\)\\s|\\d|\\w", re.I)
 regex_check = re.compile(
@@ -40,6 +54,9 @@ regex_check = re.compile(
     re.I | re.X,
 )
 emoji_re = re.compile(r"<a?:[a-zA-Z0-9_]*:(?P<id>\d*)>", re.I)
+token_re = re.compile(
+    r"([a-zA-Z0-9]{24}\.[a-zA-Z0-9]{6}\.[a-zA-Z0-9_\-]{27}|mfa\.[a-zA-Z0-9_\-]{84})"
+)
 
 
 def check_regex(content):
@@ -62,6 +79,32 @@ def check_regex(content):
         raise ValueError(
             f"Excessive escapes/`|` chars [{[*map(lambda p: p.findall(content), f)]})"
         )
+    try:
+        re.compile(content)
+    except re.error:
+        return  # Not a pattern at all, so it's matched as text
+    try:
+        compile_pattern(content)
+    except re.error:
+        raise ValueError(
+            "Highlights can't use lookarounds, backreferences or anything else "
+            "RE2 doesn't support"
+        ) from None
+
+
+def parse_invocation(ctx, subcommand, content=None):
+    """Returns the (highlight, is_regex) given to a highlight subcommand"""
+    content = content or ctx.message.content
+    cleaned_invocation = re.sub(
+        fr"{re.escape(ctx.prefix)}h(igh)?l(ight)? {subcommand} ", "", content
+    )
+    highlight_words = regex_flag.sub("", cleaned_invocation).strip()
+    with_regex = bool(regex_flag.search(content))
+    if with_regex:
+        check_regex(highlight_words)
+    if len(highlight_words) < 2:
+        raise commands.CommandError("Highlights must be more than 1 character long")
+    return highlight_words, with_regex
 
 
 def clean_emojis(content, bot):
@@ -72,144 +115,536 @@ def clean_emojis(content, bot):
     return new_content
 
 
-class Highlight:
-    def __init__(self, user_id, kw, is_regex=True):
-        self.user_id = user_id
-        self.kw = kw
-        self.is_regex = is_regex
-        self.compiled = re.compile(fr"\b{re.escape(kw)}\b", re.I)
-        if is_regex:
-            try:
-                self.compiled = re.compile(kw, re.I)
-            except re.error:
-                self.is_regex = False
-
-    def __repr__(self):
-        attrs = " ".join(f"{k}={v!r}" for k, v in self.__dict__.items())
-        return f"<{self.__class__.__name__} {attrs}>"
-
-    def check_can_send(self, message, bot):
-        predicates = []
+class Highlight(BaseHighlight):
+    def check_can_send(self, message, index):
         if not message.guild:
             return False
-        if self.user_id not in [m.id for m in message.guild.members]:
+        if message.author.bot or self.user_id == message.author.id:
             return False
-        predicates.append(
-            not re.search(
-                re.compile(
-                    r"([a-zA-Z0-9]{24}\.[a-zA-Z0-9]{6}\.[a-zA-Z0-9_\-]{27}|mfa\.["
-                    r"a-zA-Z0-9_\-]{84})"
-                ),
-                message.content,
-            )
+        if not index.is_member(message.guild.id, self.user_id):
+            return False
+        policy = index.policy(self.user_id)
+        if policy.whitelist and message.guild.id not in policy.whitelist:
+            return False
+        if message.author.id in policy.blocks or message.guild.id in policy.blocks:
+            return False
+        if token_re.search(message.content):
+            return False
+        return (
+            message.channel.permissions_for(
+                message.guild.get_member(self.user_id)
+            ).read_messages
+            is not False
         )
-        if wl := bot.user_cache[self.user_id]["hl_whitelist"]:
-            predicates.append(message.guild.id in wl)
-        if blocks := bot.user_cache[self.user_id]["hl_blocks"]:
-            predicates.extend(
-                [message.author.id not in blocks, message.guild.id not in blocks]
-            )
-        predicates.extend(
-            [
-                self.user_id != message.author.id,
-                message.channel.permissions_for(
-                    message.guild.get_member(self.user_id)
-                ).read_messages
-                is not False,
-                not message.author.bot,
-            ]
+
+
+class CachedMessage(
+    namedtuple(
+        "CachedMessage",
+        "id author_name avatar_index content has_embeds has_attachments bot",
+    )
+):
+    __slots__ = ()
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(
+            message.id,
+            message.author.name,
+            message.author.default_avatar.value,
+            message.content,
+            bool(message.embeds),
+            bool(message.attachments),
+            message.author.bot,
         )
-        return all(predicates)
 
-    @staticmethod
-    async def to_embed(match, message, bot):
+
+class ChannelHistory:
+    """Keeps the last few messages of each channel so that highlight context
+    can be rendered without fetching history from the API"""
+
+    def __init__(self, size=CONTEXT_SIZE):
+        self.size = size
+        self.channels = {}
+
+    def get(self, channel_id):
+        return tuple(self.channels.get(channel_id, ()))
+
+    def push(self, message):
+        if (ring := self.channels.get(message.channel.id)) is None:
+            ring = self.channels[message.channel.id] = deque(maxlen=self.size)
+        ring.append(CachedMessage.from_message(message))
+
+    def edit(self, message):
+        ring = self.channels.get(message.channel.id, ())
+        for index, cached in enumerate(ring):
+            if cached.id == message.id:
+                ring[index] = CachedMessage.from_message(message)
+                break
+
+    def delete(self, channel_id, message_ids):
+        if (ring := self.channels.get(channel_id)) is None:
+            return
+        kept = [cached for cached in ring if cached.id not in message_ids]
+        if len(kept) != len(ring):
+            ring.clear()
+            ring.extend(kept)
+
+    def drop(self, channel_id):
+        self.channels.pop(channel_id, None)
+
+
+class HighlightContext:
+    """The context of a highlighted message, captured when it is matched.
+
+    Embeds are only rendered at send time, and are shared between every user
+    that matched the message with the same text."""
+
+    def __init__(self, message, history):
+        self.message_id = message.id
+        self.location = f"{message.guild.name}/#{message.channel.name}"
+        self.jump_url = message.jump_url
+        self.created_at = message.created_at
+        self.history = history
+        self._embeds = {}
+
+    def to_embed(self, match, bot):
+        if (embed := self._embeds.get(match)) is not None:
+            return embed
         context_list = []
-        async for m in message.channel.history(limit=5):
-            avatar_index = m.author.default_avatar.value
+        for m in self.history:
             hl_underline = (
                 m.content.replace(match, f"**__{match}__**")
-                if m.id == message.id
+                if m.id == self.message_id
                 else m.content
             )
-            repl = r"<a?:\w*:\d*>"
-            name = discord.utils.escape_markdown(m.author.name)
+            name = discord.utils.escape_markdown(m.author_name)
             content = (
-                f"{neo.conf['emojis']['default_avs'][avatar_index]} **{name}:** "
+                f"{neo.conf['emojis']['default_avs'][m.avatar_index]} **{name}:** "
                 f"{clean_emojis(hl_underline, bot)}"
             )
-            if m.embeds:
+            if m.has_embeds:
                 content += " <:neoembed:728240626239406141>"
-            if m.attachments:
+            if m.has_attachments:
                 content += " 🖼️"
             context_list.append(content)
-        context_list.reverse()
         while len("\n".join(context_list)) > 2048:
             context_list = context_list[1:]
         embed = discord.Embed(
-            title=f'Highlighted in {message.guild.name}/#{message.channel.name} with "{shorten(match, width=25)}"',
-            description="\n".join(context_list) + f"\n[Jump URL]({message.jump_url})",
+            title=f'Highlighted in {self.location} with "{shorten(match, width=25)}"',
+            description="\n".join(context_list) + f"\n[Jump URL]({self.jump_url})",
         )
-        embed.timestamp = message.created_at
+        embed.timestamp = self.created_at
+        self._embeds[match] = embed
+        return embed
+
+
+class DeliveryLimiter:
+    """A token bucket that paces outgoing DMs"""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.rate, self.tokens + (now - self.updated) * self.rate / self.per
+        )
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def penalise(self, retry_after):
+        # Going into debt holds back every sender until the ratelimit is over
+        self._refill()
+        self.tokens = min(self.tokens, 0) - retry_after * self.rate / self.per
+
+
+class HighlightDispatcher:
+    """Queues highlights per recipient and delivers them in bulk.
+
+    Everything queued for a user between two flushes is sent as a single
+    digest DM. Deliveries run concurrently, bounded by a semaphore and paced
+    by a `DeliveryLimiter`, and anything that can't be queued is counted."""
+
+    def __init__(
+        self,
+        bot,
+        *,
+        max_pending=MAX_PENDING,
+        max_per_user=MAX_PENDING_PER_USER,
+        concurrency=DELIVERY_CONCURRENCY,
+        rate=DM_RATE,
+    ):
+        self.bot = bot
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self.queues = {}
+        self.pending = 0
+        self.stats = Counter()
+        self.reported_drops = 0
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = DeliveryLimiter(*rate)
+
+    def put(self, pending):
+        if pending.user is None:
+            self.stats["dropped_unknown_user"] += 1
+            return False
+        if self.pending >= self.max_pending:
+            self.stats["dropped_queue_full"] += 1
+            return False
+        queue = self.queues.setdefault(pending.user.id, [])
+        if len(queue) >= self.max_per_user:
+            self.stats["dropped_user_full"] += 1
+            return False
+        queue.append(pending)
+        self.pending += 1
+        self.stats["queued"] += 1
+        return True
+
+    async def flush(self):
+        queues, self.queues, self.pending = self.queues, {}, 0
+        for result in await asyncio.gather(
+            *map(self.deliver, queues.values()), return_exceptions=True
+        ):
+            if isinstance(result, Exception):
+                self.stats["failed"] += 1
+                log.error(f"Highlight delivery failed: {result!r}")
+        dropped = {k: v for k, v in self.stats.items() if k.startswith("dropped")}
+        if (total := sum(dropped.values())) > self.reported_drops:
+            log.warning(f"Highlights dropped so far: {dropped}")
+            self.reported_drops = total
+
+    async def deliver(self, items):
+        user = items[0].user
+        if len(items) == 1:
+            kwargs = {
+                "content": items[0].text,
+                "embed": items[0].context.to_embed(items[0].match, self.bot),
+            }
+        else:
+            kwargs = {"embed": self.digest_embed(items)}
+        async with self.semaphore:
+            await self.limiter.acquire()
+            try:
+                await user.send(**kwargs)
+            except discord.HTTPException as e:
+                self.stats["failed"] += len(items)
+                if e.status == 429:
+                    retry_after = (
+                        e.response.headers.get("Retry-After", 1)
+                        if e.response is not None
+                        else 1
+                    )
+                    self.limiter.penalise(float(retry_after))
+            else:
+                self.stats["delivered"] += len(items)
+                self.stats["messages_sent"] += 1
+
+    def digest_embed(self, items):
+        embed = discord.Embed(title=f"You were highlighted {len(items)} times")
+        items = items[:25]
+        # Split what's left of the limit between the fields, so the digest
+        # can't be rejected for being too long as a whole
+        budget = (EMBED_LIMIT - len(embed.title)) // len(items)
+        for pending in items:
+            context = pending.context
+            jump = f"\n[Jump URL]({context.jump_url})"
+            name = shorten(
+                f'{context.location} with "{pending.match}"',
+                width=min(256, budget // 4),
+            )
+            embed.add_field(
+                name=name,
+                value=shorten(
+                    pending.text, width=min(900, budget - len(name) - len(jump))
+                )
+                + jump,
+                inline=False,
+            )
+        embed.timestamp = items[-1].context.created_at
         return embed
 
 
 class HlMon(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.cache = []
-        self.queue = []
-        self.recents = {}
+        self.cache = {}  # user_id -> [Highlight, ...]
+        self.matcher = HighlightMatcher(on_disable=self.notify_disabled)
+        self.index = HighlightIndex()
+        self.history = ChannelHistory()
+        self.dispatcher = HighlightDispatcher(bot)
+        self.recents = TimedSet(decay_time=60)  # (channel_id, user_id) pairs
+        self.workers = None
+        settings = neo.conf.get("highlights") or {}
+        if settings.get("workers"):
+            self.workers = MatchWorkerPool(
+                self.matcher,
+                self.queue_matches,
+                workers=settings["workers"],
+                mode=settings.get("worker_mode", "thread"),
+                queue_size=settings.get("queue_size", 1000),
+                shedding=settings.get("shedding", "oldest"),
+            )
+            self.workers.start(bot.loop)
         bot.loop.create_task(self.update_highlight_cache())
         self.do_highlights.start()
+        bot.pipeline.add_stage(
+            "highlights",
+            lambda processed: self.watch_highlights(processed.message),
+            when=self.wants_message,
+            bots=True,  # Bot messages still belong in the context history
+        )
+        bot.pipeline.add_stage(
+            "highlight_recents", self.update_recents, when=self.is_owner_message
+        )
 
     def cog_unload(self):
         self.do_highlights.cancel()
+        self.bot.pipeline.remove_stage("highlights")
+        self.bot.pipeline.remove_stage("highlight_recents")
+        if self.workers is not None:
+            self.workers.stop()
+
+    def notify_disabled(self, hl, elapsed):
+        # May be called from a worker thread, so hop back onto the loop first
+        self.bot.loop.call_soon_threadsafe(self._notify_disabled, hl, elapsed)
+
+    def _notify_disabled(self, hl, elapsed):
+        log.warning(
+            f"Disabled {hl!r} after consecutive slow searches, "
+            f"the last taking {elapsed * 1000:.2f}ms"
+        )
+        self.bot.loop.create_task(
+            self.store_disabled(
+                hl,
+                f"took over {REGEX_BUDGET * 1000:.0f}ms to check against several "
+                f"messages in a row (the last took {elapsed * 1000:.0f}ms)",
+            )
+        )
+
+    async def store_disabled(self, hl, reason):
+        # So that it stays disabled after a restart. Only the process that
+        # marks it disabled tells the owner, so they're only told once
+        try:
+            stored = await self.bot.pool.fetchval(
+                "UPDATE highlights SET disabled=TRUE "
+                "WHERE user_id=$1 AND kw=$2 AND is_regex=$3 AND disabled IS NOT TRUE "
+                "RETURNING TRUE",
+                *hl.key,
+            )
+        except Exception:
+            log.exception(f"Couldn't store that {hl!r} is disabled")
+            return
+        if not stored or (user := self.bot.get_user(hl.user_id)) is None:
+            return
+        await user.send(
+            f"Your regex highlight `{shorten(hl.kw, width=175)}` {reason}, so it "
+            "has been disabled. Remove it and add a simpler pattern to keep "
+            "being highlighted for it."
+        )
+
+    def wants_message(self, processed):
+        # Only guilds that highlight owners are in need to be scanned
+        return processed.guild_id is not None and bool(
+            self.index.guilds.get(processed.guild_id)
+        )
 
-    @commands.Cog.listener(name="on_message")
     async def watch_highlights(self, msg):
-        for hl in self.cache:
-            if hl.user_id in self.recents.get(msg.channel.id, {}):
+        self.history.push(msg)
+        if msg.author.bot:
+            return  # Bots never trigger highlights, see Highlight.check_can_send
+        if self.workers is not None:
+            # Capture the context now, since it'll have moved on by the time
+            # the workers get to this message
+            history = self.history.get(msg.channel.id)
+            self.workers.submit(msg.content, (msg, history))
+        else:
+            await self.queue_matches((msg, None), self.matcher.scan(msg.content))
+
+    async def queue_matches(self, payload, matches):
+        msg, history = payload
+        context = None
+        for hl, match in matches:
+            if (msg.channel.id, hl.user_id) in self.recents:
                 continue
-            match = None
-            if m := hl.compiled.search(msg.content):
-                match = m.group(0)
-            if match is None or hl.check_can_send(msg, self.bot) is False:
+            if hl.check_can_send(msg, self.index) is False:
                 continue
-            if len(self.queue) < 40 and self.queue.count(hl.user_id) < 5:
-                self.queue.append(
-                    PendingHighlight(
-                        self.bot.get_user(hl.user_id),
-                        await hl.to_embed(match, msg, self.bot),
-                        "{0.author}: {0.content}"[:1500].format(msg),
-                    )
+            if context is None:
+                if history is None:
+                    history = self.history.get(msg.channel.id)
+                context = HighlightContext(msg, history)
+            self.dispatcher.put(
+                PendingHighlight(
+                    self.bot.get_user(hl.user_id),
+                    context,
+                    match,
+                    "{0.author}: {0.content}".format(msg)[:1500],
                 )
+            )
 
-    @commands.Cog.listener(name="on_message")
-    async def update_recents(self, msg):
-        if msg.author.id in {hl.user_id for hl in self.cache}:
-            if not self.recents.get(msg.channel.id):
-                self.recents.update(
-                    {msg.channel.id: TimedSet(decay_time=60, loop=self.bot.loop)}
-                )
-            self.recents[msg.channel.id].add(msg.author.id)
+    @commands.Cog.listener(name="on_message_edit")
+    async def edit_history(self, before, after):
+        if after.guild:
+            self.history.edit(after)
+
+    @commands.Cog.listener(name="on_raw_message_delete")
+    async def delete_history(self, payload):
+        self.history.delete(payload.channel_id, {payload.message_id})
+
+    @commands.Cog.listener(name="on_raw_bulk_message_delete")
+    async def bulk_delete_history(self, payload):
+        self.history.delete(payload.channel_id, payload.message_ids)
+
+    @commands.Cog.listener(name="on_guild_channel_delete")
+    async def drop_history(self, channel):
+        self.history.drop(channel.id)
+
+    def is_owner_message(self, processed):
+        return processed.author_id in self.cache
+
+    async def update_recents(self, processed):
+        self.recents.add((processed.channel_id, processed.author_id))
 
     @commands.Cog.listener(name="on_hl_update")
-    async def update_highlight_cache(self):
+    async def update_highlight_cache(self, user_id=None, rows=None):
+        """Patches the cache for one user, or reloads every user if none is given"""
+        await self.bot.wait_until_ready()
+        if user_id is None:
+            rows = await self.bot.pool.fetch("SELECT * FROM highlights")
+            grouped = {user_id: [] for user_id in self.cache}
+        else:
+            if rows is None:
+                rows = await self.bot.pool.fetch(
+                    "SELECT * FROM highlights WHERE user_id=$1", user_id
+                )
+            grouped = {user_id: []}
+        for record in rows:
+            grouped.setdefault(record["user_id"], []).append(record)
+        # Owners' settings are needed for their highlight policies
+        settings = await self.bot.user_cache.prefetch(grouped)
+        new_owners = [
+            user_id
+            for user_id, records in grouped.items()
+            if self.patch_user(user_id, records)
+        ]
+        self.index_owners({user_id: settings[user_id] for user_id in new_owners})
+
+    @commands.Cog.listener(name="on_hl_add")
+    async def add_to_highlight_cache(self, record):
+        """Adds a single new highlight, leaving the user's others as they are.
+        Unlike passing rows to `update_highlight_cache`, this can't drop a
+        highlight added at the same time"""
         await self.bot.wait_until_ready()
-        self.cache = [
-            Highlight(**dict(record))
-            for record in await self.bot.pool.fetch("SELECT * FROM highlights")
+        user_id = record["user_id"]
+        settings = await self.bot.user_cache.prefetch([user_id])
+        current = [
+            {
+                "user_id": user_id,
+                "kw": hl.kw,
+                "is_regex": hl.key[2],
+                "disabled": hl.key in self.matcher.disabled,
+            }
+            for hl in self.cache.get(user_id, ())
         ]
+        if self.patch_user(user_id, [*current, record]):
+            self.index_owners(settings)
+
+    def patch_user(self, user_id, records):
+        """Patches a user's highlights into the matcher, returning whether
+        they've become an owner that still needs to be indexed"""
+        current = {hl.key: hl for hl in self.cache.get(user_id, ())}
+        fetched = {}
+        disabled = set()
+        for record in records:
+            key = (record["user_id"], record["kw"], record["is_regex"])
+            # Reuse existing highlights so unchanged regexes aren't recompiled
+            fetched[key] = current.get(key) or Highlight(*key)
+            if record.get("disabled", False):  # Before migrations.sql has run
+                disabled.add(key)
+        for key in current.keys() - fetched.keys():
+            self.matcher.discard(current[key])
+        for key in fetched.keys() - current.keys():
+            self.matcher.add(fetched[key], disabled=key in disabled)
+            if fetched[key].unsupported and key not in disabled:
+                self.bot.loop.create_task(
+                    self.store_disabled(
+                        fetched[key],
+                        "uses lookarounds, backreferences or something else "
+                        "that can no longer be checked",
+                    )
+                )
+        # Disabled by another process, which has already notified the owner
+        for key in current.keys() & disabled:
+            self.matcher._disable(key)
+        if not fetched:
+            self.cache.pop(user_id, None)
+            self.index.remove_owner(user_id)
+            return False
+        self.cache[user_id] = [*fetched.values()]
+        return user_id not in self.index.owners
+
+    def index_owners(self, settings):
+        """Indexes new owners' memberships and policies, given {user_id: row}"""
+        if len(settings) == 1:
+            self.index.add_owner(next(iter(settings)), self.bot.guilds)
+        elif settings:
+            self.index.add_owners(settings, self.bot.guilds)
+        for user_id, row in settings.items():
+            self.index.set_policy(user_id, row)
+
+    @commands.Cog.listener(name="on_hl_policy_update")
+    async def update_policy(self, user_id):
+        if user_id in self.index.owners:
+            self.index.set_policy(user_id, await self.bot.user_cache.fetch(user_id))
+
+    @commands.Cog.listener(name="on_db_change")
+    async def sync_highlights(self, table, op, keys):
+        if table == "highlights":
+            await self.update_highlight_cache(keys["user_id"])
+        elif table == "user_data":
+            await self.update_policy(keys["user_id"])
+
+    @commands.Cog.listener(name="on_db_resync")
+    async def resync_highlights(self):
+        await self.update_highlight_cache()
+        settings = await self.bot.user_cache.prefetch([*self.index.owners])
+        for user_id, row in settings.items():
+            if user_id in self.index.owners:
+                self.index.set_policy(user_id, row)
+
+    @commands.Cog.listener(name="on_member_join")
+    async def index_member_join(self, member):
+        if member.id in self.index.owners:
+            self.index.add_member(member.guild.id, member.id)
+
+    @commands.Cog.listener(name="on_member_remove")
+    async def index_member_remove(self, member):
+        self.index.remove_member(member.guild.id, member.id)
+
+    @commands.Cog.listener(name="on_guild_join")
+    async def index_guild_join(self, guild):
+        self.index.add_guild(guild)
+
+    @commands.Cog.listener(name="on_guild_remove")
+    async def index_guild_remove(self, guild):
+        self.index.remove_guild(guild.id)
+        for channel in guild.channels:
+            self.history.drop(channel.id)
 
     @tasks.loop(seconds=10)
     async def do_highlights(self):
-        try:
-            for pending in set(self.queue):
-                with suppress(Exception):
-                    await pending.user.send(content=pending.text, embed=pending.embed)
-                    await asyncio.sleep(0.25)
-        finally:
-            self.queue.clear()
+        await self.dispatcher.flush()
 
     @do_highlights.before_loop
     async def wait_for_ready(self):
@@ -251,17 +686,9 @@ class HighlightCommands(commands.Cog):
 
         Currently regex highlights use the [`re.I`](https://docs.python.org/3/library/re.html#re.I) flag
         """
-        cleaned_invocation = re.sub(
-            fr"{re.escape(ctx.prefix)}h(igh)?l(ight)? add ", "", ctx.message.content
-        )
-        highlight_words = regex_flag.sub("", cleaned_invocation).strip()
-        with_regex = bool(regex_flag.search(ctx.message.content))
-        if with_regex:
-            check_regex(highlight_words)
-        if len(highlight_words) < 2:
-            raise commands.CommandError("Highlights must be more than 1 character long")
+        highlight_words, with_regex = parse_invocation(ctx, "add")
         active = await ctx.bot.pool.fetch(
-            "SELECT kw FROM highlights WHERE user_id=$1", ctx.author.id
+            "SELECT * FROM highlights WHERE user_id=$1", ctx.author.id
         )
         if len(active) >= MAX_HIGHLIGHTS:
             raise commands.CommandError(
@@ -271,15 +698,87 @@ class HighlightCommands(commands.Cog):
             raise commands.CommandError(
                 "You already have a highlight with this trigger"
             )
-        await ctx.bot.pool.execute(
-            "INSERT INTO highlights(user_id, kw, is_regex) VALUES ( $1, $2, $3 )",
+        inserted = await ctx.bot.pool.fetchrow(
+            "INSERT INTO highlights(user_id, kw, is_regex) VALUES ( $1, $2, $3 ) "
+            "RETURNING *",
             ctx.author.id,
             fr"{highlight_words}",
             with_regex,
         )
-        ctx.bot.dispatch("hl_update")
+        ctx.bot.dispatch("hl_add", inserted)
         await ctx.message.add_reaction(ctx.tick(True))
 
+    @commands.command(name="test", usage="<highlight> [--regex] [--guild]")
+    async def test_highlight(ctx):
+        """
+        Try out a highlight against recent messages in this channel, without adding it
+        If the --guild flag is passed, recent messages from the whole server are checked
+        The same rules as `add` apply, and only messages the bot has cached are checked
+        """
+        whole_guild = ctx.guild is not None and bool(
+            guild_flag.search(ctx.message.content)
+        )
+        highlight_words, with_regex = parse_invocation(
+            ctx, "test", guild_flag.sub("", ctx.message.content)
+        )
+        hl = Highlight(ctx.author.id, highlight_words, with_regex)
+        unit = MatchUnit(hl.compiled, [hl])
+
+        # Only channels the author can read, as with real highlights
+        channels = {
+            channel.id
+            for channel in (ctx.guild.channels if whole_guild else [ctx.channel])
+            if channel.permissions_for(ctx.author).read_messages
+        }
+        messages = {}
+        for message in ctx.bot.cached_messages:
+            if message.id == ctx.message.id or message.author.bot:
+                continue
+            if message.channel.id in channels:
+                messages[message.id] = message.content
+        # Messages that have fallen out of the bot's cache may still be in the rings
+        history = ctx.bot.get_cog("HlMon").history
+        for channel_id in channels:
+            for cached in history.get(channel_id):
+                if cached.id != ctx.message.id and not cached.bot:
+                    messages.setdefault(cached.id, cached.content)
+        if not messages:
+            raise commands.CommandError("There are no recent messages to test against")
+
+        hits = []
+        slow = 0
+        for content in messages.values():
+            match, elapsed = unit.search(content)
+            slow += elapsed > REGEX_BUDGET
+            if match:
+                hits.append(
+                    f"`{shorten(match.group(0), width=40)}` in "
+                    f"{shorten(content, width=80)}"
+                )
+
+        embed = discord.Embed(
+            title=f'Testing "{shorten(hl.kw, width=60)}"',
+            description="\n".join(f"- {hit}" for hit in hits[:5])
+            + (f"\n*+ {len(hits[5:])} more*" if hits[5:] else ""),
+        )
+        embed.add_field(
+            name="Hits",
+            value=f"{len(hits):,} of {unit.calls:,} messages "
+            f"in {'this server' if whole_guild else 'this channel'}",
+        )
+        embed.add_field(
+            name="Timings",
+            value=f"{unit.mean * 1000:.3f}ms mean, {unit.worst * 1000:.3f}ms worst",
+        )
+        if with_regex and not hl.is_regex:
+            embed.set_footer(text="This isn't a valid regex, so it was tested as text")
+        elif slow:
+            embed.set_footer(
+                text=f"{slow} searches took over {REGEX_BUDGET * 1000:.0f}ms, "
+                "so this highlight could be disabled"
+            )
+        await ctx.send(embed=embed)
+
     @commands.command(name="block", aliases=["unblock"])
     async def hl_block(ctx, user_or_guild=None):
         """Block and unblock users and guilds"""
@@ -297,13 +796,14 @@ class HighlightCommands(commands.Cog):
         except:
             blocked = int(snowflake)
         async with ctx.loading():
-            await ctx.bot.pool.execute(
+            row = await ctx.bot.pool.fetchrow(
                 f"UPDATE user_data SET hl_blocks = {strategy}(hl_blocks, $1) WHERE "
-                "user_id=$2",
+                "user_id=$2 RETURNING *",
                 blocked,
                 ctx.author.id,
             )
-            await ctx.bot.user_cache.refresh()
+            ctx.bot.user_cache.upsert(ctx.author.id, row)
+            ctx.bot.dispatch("hl_policy_update", ctx.author.id)
 
     @flags.add_flag("-a", "--add", nargs="*")
     @flags.add_flag("-r", "--remove", nargs="*")
@@ -321,13 +821,14 @@ class HighlightCommands(commands.Cog):
         strategy = "array_append" if flags.get("add") else "array_remove"
         snowflake = (flags.get("add") or flags.get("remove"))[0]
         async with ctx.loading():
-            await ctx.bot.pool.execute(
+            row = await ctx.bot.pool.fetchrow(
                 f"UPDATE user_data SET hl_whitelist = {strategy}(hl_whitelist, $1) WHERE "
-                "user_id=$2",
+                "user_id=$2 RETURNING *",
                 int(snowflake),
                 ctx.author.id,
             )
-            await ctx.bot.user_cache.refresh()
+            ctx.bot.user_cache.upsert(ctx.author.id, row)
+            ctx.bot.dispatch("hl_policy_update", ctx.author.id)
 
     @commands.command(name="remove", aliases=["rm", "delete", "del", "yeet"])
     async def remove_highlight(ctx, highlight_index: commands.Greedy[int]):
@@ -354,7 +855,32 @@ class HighlightCommands(commands.Cog):
                 "\n".join(shown[:5]) + extra
             )
         )
-        ctx.bot.dispatch("hl_update")
+        ctx.bot.dispatch("hl_update", ctx.author.id)
+
+    @commands.command(name="costs")
+    @commands.is_owner()
+    async def highlight_costs(ctx):
+        """
+        Show which regex highlights are the most expensive to check
+        """
+        matcher = ctx.bot.get_cog("HlMon").matcher
+        costs = [
+            "`{0}` {1.calls:,} calls, {2:.3f}ms mean, {3:.3f}ms worst\n{4}".format(
+                index,
+                unit,
+                unit.mean * 1000,
+                unit.worst * 1000,
+                " | ".join(f"`{shorten(hl.kw, width=60)}`" for hl in unit.highlights),
+            )
+            for index, unit in enumerate(matcher.costs(), 1)
+        ]
+        disabled = [
+            f"<@{hl.user_id}> `{shorten(hl.kw, width=60)}`"
+            for hl in matcher.disabled.values()
+        ]
+        if disabled:
+            costs.append("**Disabled**\n" + "\n".join(disabled))
+        await ctx.paginate(costs or ["No regex highlights"], 5, delete_on_button=True)
 
     @commands.command(name="clear", aliases=["yeetall"])
     async def clear_highlights(ctx):
@@ -366,7 +892,7 @@ class HighlightCommands(commands.Cog):
             await ctx.bot.pool.execute(
                 "DELETE FROM highlights WHERE user_id=$1", ctx.author.id
             )
-            ctx.bot.dispatch("hl_update")
+            ctx.bot.dispatch("hl_update", ctx.author.id, [])
 
 
 def setup(bot):
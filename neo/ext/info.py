@@ -32,6 +32,7 @@ from discord.ext import commands
 from discord.utils import get as _get
 from neo.utils import get_next_truck_month, rdelta_filter_null
 from neo.utils.converters import BetterUserConverter
+from neo.core.ratelimit import rate_cost
 from PIL import Image, ImageDraw, ImageOps, ImageSequence
 
 activity_type_mapping = {
@@ -179,6 +180,7 @@ class Info(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+    @rate_cost(2)
     @commands.group(aliases=["ui"], invoke_without_command=True)
     async def userinfo(self, ctx, *, target=None):
         """Get information about the targeted user"""
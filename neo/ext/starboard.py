@@ -1,10 +1,21 @@
 import asyncio
+import logging
 import textwrap
+import time
+from bisect import bisect_left, insort
+from collections.abc import Sequence
+from contextlib import suppress
 from datetime import datetime
+from itertools import islice
 from typing import Union
 
 import discord
-from discord.ext import commands
+import neo
+from discord.ext import commands, tasks
+
+log = logging.getLogger(__name__)
+
+EDIT_INTERVAL = 5.0  # Seconds over which changes to a star are coalesced
 
 
 class Star:
@@ -28,17 +39,112 @@ class Star:
         await self.referencing_message.edit(**kwargs)
 
 
+class StarIndex:
+    """Stars ordered by count, kept up to date as counts change.
+
+    Stars are bucketed by count, and the distinct counts are kept sorted,
+    so moving a star is a couple of dict operations (plus a list insert
+    when a count is first used) and ranking starts from the top bucket
+    rather than sorting every star."""
+
+    def __init__(self):
+        self.buckets = {}  # count -> {original_id: star}
+        self.counts = []  # Distinct counts, ascending
+        self.indexed = {}  # original_id -> count it's bucketed under
+
+    def __len__(self):
+        return len(self.indexed)
+
+    def add(self, star):
+        self.discard(star.original_id)
+        if (bucket := self.buckets.get(star.stars)) is None:
+            bucket = self.buckets[star.stars] = {}
+            insort(self.counts, star.stars)
+        bucket[star.original_id] = star
+        self.indexed[star.original_id] = star.stars
+
+    def discard(self, id):
+        if (count := self.indexed.pop(id, None)) is None:
+            return
+        bucket = self.buckets[count]
+        del bucket[id]
+        if not bucket:
+            del self.buckets[count]
+            del self.counts[bisect_left(self.counts, count)]
+
+    def update(self, star):
+        if self.indexed.get(star.original_id) != star.stars:
+            self.add(star)
+
+    def ranked(self, start, stop):
+        """The stars ranked from `start` to `stop`, most stars first"""
+        remaining = stop - start
+        for count in reversed(self.counts):
+            if remaining <= 0:
+                break
+            bucket = self.buckets[count]
+            if start >= len(bucket):
+                start -= len(bucket)
+                continue
+            stars = [*islice(bucket.values(), start, start + remaining)]
+            yield from stars
+            remaining -= len(stars)
+            start = 0
+
+
+class Leaderboard(Sequence):
+    """Formats a `StarIndex` lazily, one page's slice at a time"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item : item + 1][0]
+        start, stop, _ = item.indices(len(self))
+        return [
+            "{0} [{1.stars} stars]({1.referencing_message.jump_url})".format(
+                rank, star
+            )
+            for rank, star in enumerate(self.index.ranked(start, stop), start + 1)
+        ]
+
+
 class Starboard:
     def __init__(
-        self, *, channel: discord.TextChannel, stars, format, required_stars, max_days
+        self,
+        *,
+        channel: discord.TextChannel,
+        stars,
+        format,
+        required_stars,
+        max_days,
+        pool,
+        edit_interval=EDIT_INTERVAL,
     ):
         self.channel = channel
         self.required_stars = required_stars
         self.max_days = max_days
         self._stars = stars
         self._cached_stars = {}
+        self.index = StarIndex()
         self._format = format
         self._ready = False
+        # Star counts of messages that aren't starred yet, kept from reaction
+        # events so that the message only needs fetching near the requirement
+        self.counts = {}
+        # Stars whose counts may have missed events, see reconcile_stars
+        self.stale = set()
+        # Messages after this snowflake have had all their reactions seen
+        self.tracking_since = discord.utils.time_snowflake(datetime.utcnow())
+        self.pool = pool
+        self.edit_interval = edit_interval
+        self._pending = {}  # original_id -> task waiting to flush that star
+        self._flushing = set()  # Tasks that are writing a star right now
+        self._flushed = {}  # original_id -> star count last flushed
 
     def __await__(self):
         return self.__ainit__().__await__()
@@ -47,20 +153,37 @@ class Starboard:
         for star in self._stars:
 
             try:
-                message = self.channel.get_partial_message(star["starred_message_id"])
+                self.load_star(star)
 
             except Exception as e:
                 print(e)
                 continue
 
-            self._cached_stars[star["message_id"]] = Star(
+        self._ready = True
+        return self
+
+    def load_star(self, row):
+        """Adds or updates a star from its starboard_msgs row"""
+        if (star := self.get_star(row["message_id"])) is None:
+            message = self.channel.get_partial_message(row["starred_message_id"])
+            star = self._cached_stars[row["message_id"]] = Star(
                 referencing_message=message,
-                stars=star["stars"],
-                original_id=star["message_id"],
+                stars=row["stars"],
+                original_id=row["message_id"],
             )
+        else:
+            star.stars = row["stars"]
+        self._flushed[star.original_id] = row["stars"]
+        self.index.update(star)
+        return star
 
-        self._ready = True
-        return self
+    def forget_star(self, id):
+        """Drops a star without deleting its message, for when it's already
+        been removed elsewhere"""
+        self._cached_stars.pop(id, None)
+        self.index.discard(id)
+        self._cancel_flush(id)
+        self._flushed.pop(id, None)
 
     @property
     def stars(self):
@@ -69,6 +192,22 @@ class Starboard:
     def get_star(self, id):
         return self._cached_stars.get(id)
 
+    def is_expired(self, id, now=None):
+        age = (now or datetime.utcnow()) - discord.utils.snowflake_time(id)
+        return age.days > self.max_days
+
+    def restart_tracking(self):
+        """Distrusts every count, for when reaction events may have been missed"""
+        self.tracking_since = discord.utils.time_snowflake(datetime.utcnow())
+        self.counts.clear()
+        self.stale.update(self.stars)
+
+    def prune_counts(self):
+        now = datetime.utcnow()
+        for id in [*self.counts]:
+            if self.is_expired(id, now):
+                del self.counts[id]
+
     async def create_star(self, message, stars):
         if not self._ready:
             return
@@ -105,6 +244,7 @@ class Starboard:
 
         star = Star(**kwargs)
         self._cached_stars[star.original_id] = star
+        self.index.add(star)
         return star
 
     async def destroy_star(self, id):
@@ -112,58 +252,243 @@ class Starboard:
             return
 
         star = self._cached_stars.pop(id)
+        self.index.discard(id)
+        # The star is deleted outright, which supersedes any pending update
+        self._cancel_flush(id)
+        self._flushed.pop(id, None)
         try:
             await star.referencing_message.delete()
         finally:
             return star
 
     async def update_star(self, id, stars):
+        """Changes a star's count, which is written to its message and the
+        database at most once every `edit_interval` seconds"""
         if not self._ready:
             return
 
         star = self.get_star(id)
         star.stars = stars
+        self.index.update(star)
 
-        content = self._format.format(stars=star.stars)
-        await star.edit(content=content)
+        if id not in self._pending:
+            self._pending[id] = asyncio.ensure_future(self._flush_later(star))
 
         return star
 
+    async def _flush_later(self, star):
+        await asyncio.sleep(self.edit_interval)
+        # Changes made while flushing schedule a new flush, so the final
+        # count is always written
+        task = self._pending.pop(star.original_id)
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+        await self.flush_star(star)
+
+    def _cancel_flush(self, id):
+        if (task := self._pending.pop(id, None)) is not None:
+            task.cancel()
+
+    async def flush_star(self, star):
+        """Writes a star's count to its message and the database. Failures
+        are logged rather than raised, and the count is only marked as
+        flushed once it's saved, so the next update retries it"""
+        stars = star.stars
+        if self._flushed.get(star.original_id) == stars:
+            return
+        try:
+            await star.edit(content=self._format.format(stars=stars))
+        except discord.HTTPException:
+            log.warning("Couldn't edit star %s", star.original_id, exc_info=True)
+        query = """
+        UPDATE starboard_msgs
+        SET stars = $1
+        WHERE message_id = $2
+        """
+        try:
+            await self.pool.execute(query, stars, star.original_id)
+        except Exception:
+            log.exception("Couldn't save the count of star %s", star.original_id)
+        else:
+            self._flushed[star.original_id] = stars
+
+    async def flush(self):
+        """Writes every pending update now, and waits for those already
+        being written"""
+        for id in [*self._pending]:
+            self._cancel_flush(id)
+            if (star := self.get_star(id)) is not None:
+                await self.flush_star(star)
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+
 
 class StarboardCog(commands.Cog, name="Starboard"):
     def __init__(self, bot):
         self.bot = bot
         self._ready = False
-        self.starboards = {}
+        self.starboards = {}  # Only guilds whose starboards have been loaded
+        self._loading = {}  # guild_id -> task loading its starboard
+        settings = neo.conf.get("starboard") or {}
+        self.edit_interval = settings.get("edit_interval", EDIT_INTERVAL)
+        self._in_flight = {}  # message_id -> last queued star change
+        self._fetched_at = {}  # message_id -> when it was last fetched, while queued
         bot.loop.create_task(self.__ainit__())
+        self.prune_star_counts.start()
+        bot.metrics.add_gauge(
+            "starboards",
+            lambda: {
+                (("state", state),): len(guilds)
+                for state, guilds in self.readiness().items()
+            },
+        )
+
+    def cog_unload(self):
+        self.prune_star_counts.cancel()
+        self.bot.metrics.remove_gauge("starboards")
+
+    def readiness(self):
+        """The guilds with a starboard, by whether it's loaded, being loaded on
+        its own, or waiting for the bulk load"""
+        configured = {
+            guild_id
+            for guild_id, config in self.bot.guild_cache.items()
+            if config.get("starboard_channel_id")
+        }
+        loaded = {*self.starboards}
+        loading = {*self._loading} - loaded
+        return {
+            "loaded": loaded,
+            "loading": loading,
+            "waiting": configured - loaded - loading,
+        }
+
+    async def cog_close(self):
+        for starboard in self.starboards.values():
+            await starboard.flush()
 
     async def __ainit__(self):
         await self.bot.wait_until_ready()
+        start = time.perf_counter()
+        await self.load_starboards()
+        self._ready = True
+        log.info(
+            "Loaded %s starboards in %.2fs",
+            len(self.starboards),
+            time.perf_counter() - start,
+        )
 
-        for guild, config in self.bot.guild_cache.items():
-            if not config.get("starboard_channel_id"):
-                continue
+    async def load_starboards(self, *, replace=False):
+        """Loads every starboard with one query. Starboards that were loaded
+        in the meantime are kept unless `replace` is passed"""
+        configs = {
+            guild_id: config
+            for guild_id, config in self.bot.guild_cache.items()
+            if config.get("starboard_channel_id")
+        }
+        query = """
+        SELECT guild_id, message_id, stars, starred_message_id
+        FROM starboard_msgs
+        WHERE guild_id = ANY($1::BIGINT[])
+        """
+
+        starred_messages = {guild_id: [] for guild_id in configs}
+        for row in await self.bot.pool.fetch(query, [*configs]):
+            starred_messages[row["guild_id"]].append(row)
 
+        starboards = {
+            guild_id: await self.make_starboard(config, starred_messages[guild_id])
+            for guild_id, config in configs.items()
+        }
+        if replace:
+            self.starboards = starboards
+        else:
+            for guild_id, starboard in starboards.items():
+                self.starboards.setdefault(guild_id, starboard)
+
+    async def load_starboard(self, guild_id, config):
+        query = """
+        SELECT message_id, stars, starred_message_id
+        FROM starboard_msgs
+        WHERE guild_id = $1
+        """
+
+        return await self.make_starboard(
+            config, await self.bot.pool.fetch(query, guild_id)
+        )
+
+    async def get_starboard(self, guild_id):
+        """A guild's starboard, loading it first if it's needed before the
+        rest have been loaded"""
+        if (starboard := self.starboards.get(guild_id)) is not None:
+            return starboard
+        config = self.bot.guild_cache.get(guild_id) or {}
+        if not config.get("starboard_channel_id"):
+            return None
+        if (loading := self._loading.get(guild_id)) is None:
+            loading = self._loading[guild_id] = asyncio.ensure_future(
+                self.load_starboard(guild_id, config)
+            )
+            loading.add_done_callback(lambda _: self._loading.pop(guild_id, None))
+        starboard = await asyncio.shield(loading)
+        if guild_id not in self.starboards:
+            log.debug("Loaded the starboard of guild %s ahead of the rest", guild_id)
+        return self.starboards.setdefault(guild_id, starboard)
+
+    async def make_starboard(self, config, starred_messages):
+        kwargs = {
+            "channel": self.bot.get_channel(config["starboard_channel_id"]),
+            "stars": starred_messages,
+            "format": config["starboard_format"],
+            "required_stars": config["starboard_star_requirement"],
+            "max_days": config["starboard_max_days"],
+            "pool": self.bot.pool,
+            "edit_interval": self.edit_interval,
+        }
+
+        return await Starboard(**kwargs)
+
+    @commands.Cog.listener("on_db_change")
+    async def sync_starboard(self, table, op, keys):
+        if table not in ("guild_prefs", "starboard_msgs"):
+            return
+        guild_id = keys["guild_id"]
+        config = self.bot.guild_cache.get(guild_id) or {}
+        if not config.get("starboard_channel_id"):
+            self.starboards.pop(guild_id, None)
+            return
+
+        if (starboard := self.starboards.get(guild_id)) is None:
+            return  # It's loaded with the change whenever it's first needed
+        if table == "starboard_msgs" and (message_id := keys.get("message_id")):
+            # Only the one star changed
+            if op == "DELETE":
+                starboard.forget_star(message_id)
+                return
             query = """
             SELECT message_id, stars, starred_message_id
             FROM starboard_msgs
-            WHERE guild_id = $1
+            WHERE message_id = $1
             """
+            if (row := await self.bot.pool.fetchrow(query, message_id)) is not None:
+                starboard.load_star(row)
+            return
+        if (
+            table == "guild_prefs"
+            and getattr(getattr(starboard, "channel", None), "id", None)
+            == config["starboard_channel_id"]
+        ):
+            # Only the settings changed, so the stars are still valid
+            starboard.required_stars = config["starboard_star_requirement"]
+            starboard._format = config["starboard_format"]
+            starboard.max_days = config["starboard_max_days"]
+            return
+        self.starboards[guild_id] = await self.load_starboard(guild_id, config)
 
-            starred_messages = await self.bot.pool.fetch(query, guild)
-            kwargs = {
-                "channel": self.bot.get_channel(config["starboard_channel_id"]),
-                "stars": starred_messages,
-                "format": config["starboard_format"],
-                "required_stars": config["starboard_star_requirement"],
-                "max_days": config["starboard_max_days"],
-            }
-
-            self.starboards[guild] = Starboard(**kwargs)
-
-        await asyncio.gather(*self.starboards.values())
-
-        self._ready = True
+    @commands.Cog.listener("on_db_resync")
+    async def resync_starboards(self):
+        if self._ready:
+            await self.load_starboards(replace=True)
 
     async def get_message(self, channel, message_id):
         message = await channel.history(
@@ -174,36 +499,114 @@ class StarboardCog(commands.Cog, name="Starboard"):
     def reaction_check(self, payload):
         return str(payload.emoji) == "⭐"
 
+    def star_count(self, message):
+        return getattr(
+            discord.utils.get(message.reactions, emoji="\N{WHITE MEDIUM STAR}"),
+            "count",
+            0,
+        )
+
+    def changed_count(self, payload, count):
+        if isinstance(payload, discord.RawReactionActionEvent):
+            if payload.event_type == "REACTION_ADD":
+                return count + 1
+            return max(count - 1, 0)
+        return 0  # Reactions were cleared
+
+    @tasks.loop(hours=1)
+    async def prune_star_counts(self):
+        for starboard in self.starboards.values():
+            starboard.prune_counts()
+
+    @commands.Cog.listener("on_ready")
+    @commands.Cog.listener("on_resumed")
+    async def reconcile_stars(self):
+        # Reactions may have been missed while disconnected, so counts can't be
+        # trusted until the messages are fetched again
+        for starboard in self.starboards.values():
+            starboard.restart_tracking()
+
     @commands.Cog.listener("on_raw_reaction_add")
     @commands.Cog.listener("on_raw_reaction_remove")
     @commands.Cog.listener("on_raw_reaction_clear")
     @commands.Cog.listener("on_raw_reaction_clear_emoji")
     @commands.Cog.listener("on_raw_message_delete")
     async def handle_star_changes(self, payload):
-        if not (starboard := self.starboards.get(payload.guild_id)):
+        if not self.bot.guild_cache[payload.guild_id].get("starboard", False):
+            # Ignored while it's turned off, so it can't trust its counts after
+            if (starboard := self.starboards.get(payload.guild_id)) is not None:
+                starboard.restart_tracking()
             return
-        if not starboard._ready:
+        if isinstance(
+            payload,
+            (discord.RawReactionActionEvent, discord.RawReactionClearEmojiEvent),
+        ) and not self.reaction_check(payload):
             return
-        if not self.bot.guild_cache[payload.guild_id].get("starboard", False):
+        # Loaded guilds are handled straight away, even while others load
+        if not (starboard := await self.get_starboard(payload.guild_id)):
+            return
+        if not starboard._ready:
             return
         if payload.channel_id == starboard.channel.id:
             return
-        if (
-            datetime.utcnow() - discord.Object(payload.message_id).created_at
-        ).days > starboard.max_days:
+        if starboard.is_expired(payload.message_id):
             return
 
+        # Changes to one message are applied one at a time, so that a burst of
+        # reactions waits on the first to fetch and star the message instead
+        # of each fetching, sending and inserting it
+        received = time.monotonic()
+        previous = self._in_flight.get(payload.message_id)
+        flight = self._in_flight[payload.message_id] = asyncio.ensure_future(
+            self.apply_star_change(starboard, payload, received, previous)
+        )
+        try:
+            await asyncio.shield(flight)
+        finally:
+            if self._in_flight.get(payload.message_id) is flight:
+                del self._in_flight[payload.message_id]
+                self._fetched_at.pop(payload.message_id, None)
+
+    async def fetch_message(self, payload):
+        # Taken before the request, since events received while it's in
+        # flight may not be reflected in what it returns
+        requested = time.monotonic()
+        message = await self.get_message(
+            self.bot.get_channel(payload.channel_id), payload.message_id
+        )
+        self._fetched_at[payload.message_id] = requested
+        return message
+
+    async def apply_star_change(self, starboard, payload, received, previous=None):
+        if previous is not None:
+            with suppress(Exception):  # Already raised in its own handler
+                await previous
+        if self._fetched_at.get(payload.message_id, 0) > received:
+            return  # The message was fetched since, so its count includes this
+
         if (star := starboard.get_star(payload.message_id)) is None:
 
-            message = await self.get_message(
-                self.bot.get_channel(payload.channel_id), payload.message_id
-            )
+            if isinstance(payload, discord.RawMessageDeleteEvent):
+                starboard.counts.pop(payload.message_id, None)
+                return
+            count = starboard.counts.get(payload.message_id)
+            if count is None and payload.message_id > starboard.tracking_since:
+                count = 0
+            if count is not None:
+                count = starboard.counts[payload.message_id] = self.changed_count(
+                    payload, count
+                )
+            # Only an added star can reach the requirement. Messages from before
+            # tracking started are fetched once to find their count, others
+            # only when they're within a star of it
+            if self.changed_count(payload, 0) == 0:
+                return
+            if count is not None and count < starboard.required_stars - 1:
+                return
 
-            count = getattr(
-                discord.utils.get(message.reactions, emoji="\N{WHITE MEDIUM STAR}"),
-                "count",
-                0,
-            )
+            message = await self.fetch_message(payload)
+
+            count = starboard.counts[payload.message_id] = self.star_count(message)
             if count < starboard.required_stars:
                 return
 
@@ -211,6 +614,7 @@ class StarboardCog(commands.Cog, name="Starboard"):
 
             if not star:
                 return
+            starboard.counts.pop(payload.message_id, None)
 
             query = """
             INSERT INTO starboard_msgs (
@@ -233,24 +637,14 @@ class StarboardCog(commands.Cog, name="Starboard"):
 
         else:
 
-            if isinstance(payload, discord.RawReactionActionEvent):
-                if not self.reaction_check(payload):
-                    return
-
-                if payload.event_type == "REACTION_ADD":
-                    star.stars += 1
-                else:
-                    star.stars -= 1
-
-            elif isinstance(payload, discord.RawReactionClearEmojiEvent):
-                if not self.reaction_check(payload):
-                    return
-                star.stars = 0
-
-            elif isinstance(
-                payload, (discord.RawReactionClearEvent, discord.RawMessageDeleteEvent)
+            if payload.message_id in starboard.stale and isinstance(
+                payload, discord.RawReactionActionEvent
             ):
-                star.stars = 0
+                message = await self.fetch_message(payload)
+                star.stars = self.star_count(message)
+            else:
+                star.stars = self.changed_count(payload, star.stars)
+            starboard.stale.discard(payload.message_id)
 
             if star.stars < starboard.required_stars:
                 await starboard.destroy_star(star.original_id)
@@ -258,18 +652,12 @@ class StarboardCog(commands.Cog, name="Starboard"):
                 await self.bot.pool.execute(query, star.original_id)
             else:
                 await starboard.update_star(star.original_id, star.stars)
-                query = """
-                UPDATE starboard_msgs
-                SET stars = $1
-                WHERE message_id = $2
-                """
-                await self.bot.pool.execute(query, star.stars, star.original_id)
 
     @commands.group(invoke_without_command=True)
     @commands.guild_only()
     @commands.has_permissions(manage_channels=True)
     async def starboard(self, ctx):
-        if not (starboard := self.starboards.get(ctx.guild.id)):
+        if not (starboard := await self.get_starboard(ctx.guild.id)):
             raise commands.BadArgument(
                 "Starboard has not been enabled for this guild yet"
             )
@@ -292,32 +680,12 @@ class StarboardCog(commands.Cog, name="Starboard"):
     @commands.guild_only()
     async def leaderboard(self, ctx):
         """Shows a ranked listing of all starred messages"""
-        if ctx.guild.id not in self.starboards:
+        if not (starboard := await self.get_starboard(ctx.guild.id)):
             raise commands.CommandError("This server doesn't have a starboard!")
 
-        starboard = self.starboards.get(ctx.guild.id)
-
-        embed = discord.Embed(
-            title=f"{ctx.guild} Starboard Leaderboard", description=""
-        )
-        top_stars = []
-
-        for index, star in enumerate(
-            sorted(starboard.stars.values(), key=lambda star: star.stars, reverse=True),
-            1,
-        ):
-            try:
-                top_stars.append(
-                    "{0} [{1.stars} stars]({1.referencing_message.jump_url})".format(
-                        index, star
-                    )
-                )
-
-            except IndexError:
-                break
-
+        # Only the page being shown is ranked and formatted
         await ctx.paginate(
-            top_stars,
+            Leaderboard(starboard.index),
             5,
             delete_on_button=True,
             clear_reactions_after=True,
@@ -330,7 +698,7 @@ class StarboardCog(commands.Cog, name="Starboard"):
     @commands.has_permissions(manage_channels=True)
     @commands.bot_has_permissions(manage_channels=True)
     async def create(self, ctx, *, channel: Union[discord.TextChannel, str] = None):
-        if ctx.guild.id in self.starboards:
+        if await self.get_starboard(ctx.guild.id):
             raise commands.BadArgument(
                 "You already have a starboard, use `change` to set your starboard to a different channel"
             )
@@ -363,9 +731,11 @@ class StarboardCog(commands.Cog, name="Starboard"):
             format=row["starboard_format"],
             required_stars=row["starboard_star_requirement"],
             max_days=row["starboard_max_days"],
+            pool=self.bot.pool,
+            edit_interval=self.edit_interval,
         )
         self.starboards[ctx.guild.id] = starboard
-        self.bot.guild_cache[ctx.guild.id].update(dict(row))
+        self.bot.guild_cache.upsert(ctx.guild.id, row)
         await ctx.send(
             f"Created starboard which resides at {starboard.channel.mention}"
         )
@@ -374,7 +744,7 @@ class StarboardCog(commands.Cog, name="Starboard"):
     @commands.has_permissions(manage_channels=True)
     @commands.bot_has_permissions(manage_channels=True)
     async def change(self, ctx, *, channel: discord.TextChannel = None):
-        if ctx.guild.id not in self.starboards:
+        if not (starboard := await self.get_starboard(ctx.guild.id)):
             raise commands.BadArgument(
                 "You don't have a preexisting starboard, use `create` instead!"
             )
@@ -393,17 +763,17 @@ class StarboardCog(commands.Cog, name="Starboard"):
             }
             await channel.edit(overwrites=overwrites)
 
-        self.starboards[ctx.guild.id].channel = channel
+        starboard.channel = channel
         channel = getattr(channel, "id", channel)
         await self.bot.pool.execute(
             "SELECT change_starboard($1, $2); ", channel, ctx.guild.id
         )
 
-        self.bot.guild_cache[ctx.guild.id].update({"starboard_channel_id": channel})
+        self.bot.guild_cache.patch(ctx.guild.id, starboard_channel_id=channel)
         if channel:
             await ctx.send("Starboard relocated")
         else:
-            self.starboards.pop(ctx.guild.id)
+            self.starboards.pop(ctx.guild.id, None)
             await ctx.send("Starboard has been disbanded")
 
     @starboard.command(name="set")
@@ -421,16 +791,17 @@ class StarboardCog(commands.Cog, name="Starboard"):
         RETURNING *;
         """
         ret = await self.bot.pool.fetchrow(query.format(key), value, ctx.guild.id)
-        self.bot.guild_cache[ctx.guild.id] = dict(ret)
+        self.bot.guild_cache.upsert(ctx.guild.id, ret)
 
-        starboard = self.starboards[ctx.guild.id]
-        if key == "star_requirement":
-            starboard.required_stars = value
+        # Starboards that haven't been loaded yet are loaded with the new value
+        if (starboard := self.starboards.get(ctx.guild.id)) is not None:
+            if key == "star_requirement":
+                starboard.required_stars = value
 
-        elif key == "format":
-            starboard._format = value
-        elif key == "max_days":
-            starboard.max_days = value
+            elif key == "format":
+                starboard._format = value
+            elif key == "max_days":
+                starboard.max_days = value
 
         await ctx.send(f"Setting `{key}` successfully changed to `{value}`")
 
@@ -16,56 +16,356 @@ You should have received a copy of the GNU Affero General Public License
 along with neo.  If not, see <https://www.gnu.org/licenses/>.
 """
 import asyncio
-from collections import namedtuple, defaultdict
-from contextlib import suppress
+import logging
+import time
+from collections import Counter, defaultdict
+from collections.abc import MutableMapping, MutableSet
+from functools import lru_cache
 
-__all__ = ("TimedSet", "DbCache")
+__all__ = ("TimedSet", "TimedDict", "DbCache")
 
-PendingValue = namedtuple("PendingValue", "item task")
+log = logging.getLogger(__name__)
 
 
-class TimedSet(set):
-    def __init__(self, *args, decay_time, loop=None, **kwargs):
+class _Expiring:
+    """Keeps items in a dict ordered by deadline.
+
+    Every item lives for the same `decay_time`, so re-inserting an item on
+    refresh keeps the dict sorted and expired items can only ever be at its
+    front. Adds and refreshes are O(1), lookups check the deadline lazily,
+    and sweeping happens as part of writes instead of in per-item tasks."""
+
+    def __init__(self, decay_time, loop=None):
         self.decay_time = decay_time
-        self.loop = loop or asyncio.get_event_loop()
-        self.running = {}
-        super().__init__(*args, **kwargs)
-        for item in self:
+        self.loop = loop  # Unused, kept for compatibility
+        self._deadlines = {}
+
+    def _expired(self, item, now=None):
+        deadline = self._deadlines.get(item)
+        return deadline is not None and deadline <= (now or time.monotonic())
+
+    def _touch(self, item):
+        self._deadlines.pop(item, None)
+        self._deadlines[item] = time.monotonic() + self.decay_time
+
+    def _forget(self, item):
+        self._deadlines.pop(item, None)
+
+    def sweep(self):
+        now = time.monotonic()
+        expired = []
+        for item, deadline in self._deadlines.items():
+            if deadline > now:
+                break
+            expired.append(item)
+        for item in expired:
+            self._forget(item)
+        return len(expired)
+
+
+class TimedSet(_Expiring, MutableSet):
+    """A set whose items are discarded `decay_time` seconds after they were last added"""
+
+    def __init__(self, *args, decay_time, loop=None, **kwargs):
+        super().__init__(decay_time, loop)
+        for item in set(*args, **kwargs):
             self.add(item)
 
+    def __repr__(self):
+        return f"{self.__class__.__name__}({{{', '.join(map(repr, self))}}})"
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        # Results of set operations don't expire
+        return set(iterable)
+
+    def __contains__(self, item):
+        return item in self._deadlines and not self._expired(item)
+
+    def __iter__(self):
+        self.sweep()
+        return iter([*self._deadlines])
+
+    def __len__(self):
+        self.sweep()
+        return len(self._deadlines)
+
     def add(self, item):
-        with suppress(KeyError):
-            if con := self.running.pop(item):
-                con.task.cancel()
-                self.discard(item)
-        super().add(item)
-        task = self.loop.create_task(self.decay(item))
-        self.running[item] = PendingValue(item, task)
+        self.sweep()
+        self._touch(item)
+
+    def discard(self, item):
+        self._forget(item)
+
+
+class TimedDict(_Expiring, MutableMapping):
+    """A dict whose items are removed `decay_time` seconds after they were last set"""
+
+    def __init__(self, *args, decay_time, loop=None, **kwargs):
+        super().__init__(decay_time, loop)
+        self._data = {}
+        self.update(*args, **kwargs)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({dict(self.items())!r})"
+
+    def _forget(self, item):
+        super()._forget(item)
+        self._data.pop(item, None)
+
+    def __getitem__(self, key):
+        if self._expired(key):
+            self._forget(key)
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self.sweep()
+        self._touch(key)
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        if key not in self._data:
+            raise KeyError(key)
+        self._forget(key)
+
+    def __iter__(self):
+        self.sweep()
+        return iter([*self._data])
+
+    def __len__(self):
+        self.sweep()
+        return len(self._data)
+
+
+class CompactRow(MutableMapping):
+    """A row stored in slots rather than a dict, which is much smaller when
+    there are many rows with the same columns. Columns can be changed, but
+    not added or removed."""
 
-    async def decay(self, item):
-        await asyncio.sleep(self.decay_time)
-        self.discard(item)
+    __slots__ = ()
+    _columns = ()
+
+    def __init__(self, *values):
+        for column, value in zip(self._columns, values):
+            object.__setattr__(self, column, value)
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(*map(record.__getitem__, cls._columns))
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            raise KeyError(column)
+        return getattr(self, column)
+
+    def __setitem__(self, column, value):
+        if column not in self._columns:
+            raise KeyError(column)
+        object.__setattr__(self, column, value)
+
+    def __delitem__(self, column):
+        raise TypeError("Columns can't be removed from a row")
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({dict(self)!r})"
+
+
+@lru_cache(maxsize=None)
+def compact_row(columns):
+    """Returns a `CompactRow` class for a tuple of column names"""
+    return type(
+        "CompactRow", (CompactRow,), {"__slots__": columns, "_columns": columns}
+    )
 
 
 class DbCache(defaultdict):
-    def __init__(self, *, db_query, query_params=[], pool, key):
+    """A cache of database rows keyed by `key`.
+
+    Mutations should hand the row they return (via `RETURNING *`) to
+    `upsert`, rather than reloading the whole table with `refresh`.
+
+    By default the whole of `db_query` is loaded up front. With `lazy`, rows
+    are instead loaded through `row_query` (which takes an array of keys as
+    $1) by `fetch` as they're needed, with keys fetched in the same loop
+    iteration sharing a query, and the least recently fetched rows are
+    evicted past `max_size`. Rows older than `ttl` are reloaded, and keys
+    without a row are remembered for `negative_ttl`.
+
+    With `compact`, rows are stored as `CompactRow`s instead of dicts."""
+
+    def __init__(
+        self,
+        *,
+        db_query,
+        query_params=[],
+        pool,
+        key,
+        row_query=None,
+        lazy=False,
+        max_size=None,
+        ttl=None,
+        negative_ttl=300,
+        compact=False,
+    ):
         super().__init__(dict)
         self.pool = pool
         self.db_query = db_query
         self.query_params = query_params
         self.key = key
+        self.row_query = row_query
+        self.lazy = lazy
+        self.max_size = max_size
+        self.ttl = ttl
+        self.compact = compact
+        self.stats = Counter()
+        self._loaded = {}  # key -> when the row was cached
+        self._missing = TimedSet(decay_time=negative_ttl)
+        self._batch = {}  # key -> future, for the next batched load
+        self._loads = set()  # Held so that running loads aren't collected
+
+    def __missing__(self, key):
+        # Unknown keys read as an empty row, but aren't inserted
+        return {}
 
     def __await__(self):
         return self._build_cache().__await__()
 
+    def _row(self, record):
+        if self.compact:
+            columns = tuple(column for column in record.keys() if column != self.key)
+            return compact_row(columns).from_record(record)
+        copied = dict(record)
+        copied.pop(self.key, None)
+        return copied
+
+    def _split(self, records):
+        return {record[self.key]: self._row(record) for record in records}
+
     async def _build_cache(self):
-        data = await self.pool.fetch(self.db_query, *self.query_params)
-        for record in data:
-            copied = dict(record)
-            self[copied.pop(self.key)] = copied
+        if self.lazy:
+            if not self:
+                return self
+            data = await self.pool.fetch(self.row_query, [*self])
+        else:
+            data = await self.pool.fetch(self.db_query, *self.query_params)
+        rows = self._split(data)
+        # Swap the rows in without awaiting, so reads never see a partial cache
+        self.clear()
+        self._loaded.clear()
+        for key, row in rows.items():
+            self._store(key, row)
         return self
 
     async def refresh(self):
-        self.clear()
+        """Reloads every row, or every cached row if the cache is lazy"""
         await self._build_cache()
         return self
+
+    def _store(self, key, row, now=None):
+        self.pop(key, None)  # Reinserting moves it to the back of the LRU order
+        self[key] = row
+        if self.lazy:
+            self._loaded[key] = now or time.monotonic()
+            self._missing.discard(key)
+            while self.max_size is not None and len(self) > self.max_size:
+                oldest = next(iter(self))
+                del self[oldest]
+                del self._loaded[oldest]
+                self.stats["evictions"] += 1
+
+    async def reload(self, key):
+        """Reloads the row for `key` after it was changed elsewhere"""
+        if self.lazy and key not in self:
+            # Nothing to reload, but it may no longer be missing
+            self._missing.discard(key)
+            return None
+        records = await self.pool.fetch(self.row_query, [key])
+        return self.upsert(key, records[0] if records else None)
+
+    async def fetch(self, key):
+        """Returns the row for `key`, loading it first if the cache is lazy,
+        or None if there isn't one"""
+        if not self.lazy:
+            return self.get(key)
+        now = time.monotonic()
+        if key in self:
+            if self.ttl is None or now - self._loaded[key] < self.ttl:
+                self.stats["hits"] += 1
+                self._store(key, self[key], self._loaded[key])
+                return self[key]
+            self.stats["expired"] += 1
+        elif key in self._missing:
+            self.stats["negative_hits"] += 1
+            return None
+        self.stats["misses"] += 1
+        if (future := self._batch.get(key)) is None:
+            if not self._batch:
+                task = asyncio.ensure_future(self._load_batch())
+                self._loads.add(task)
+                task.add_done_callback(self._load_done)
+            future = self._batch[key] = asyncio.get_event_loop().create_future()
+        # Shielded, since the future may be shared with other callers
+        return await asyncio.shield(future)
+
+    async def prefetch(self, keys):
+        """Loads any of `keys` that aren't cached, in a single query, and
+        returns {key: row}, with None for keys without a row.
+
+        The rows are returned rather than left to be read from the cache,
+        since loading more than `max_size` keys evicts some of them again"""
+        keys = [*keys]
+        if not self.lazy:
+            return {key: self.get(key) for key in keys}
+        return dict(zip(keys, await asyncio.gather(*map(self.fetch, keys))))
+
+    def _load_done(self, task):
+        self._loads.discard(task)
+        if not task.cancelled() and (exc := task.exception()) is not None:
+            log.error(f"Loading a batch of cached rows failed: {exc!r}")
+
+    async def _load_batch(self):
+        batch, self._batch = self._batch, {}
+        started = time.monotonic()
+        try:
+            rows = self._split(await self.pool.fetch(self.row_query, [*batch]))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        self.stats["loads"] += 1
+        now = time.monotonic()
+        for key, future in batch.items():
+            if self._loaded.get(key, 0) > started:
+                # Upserted while the query was running, which is newer
+                row = self[key]
+            elif (row := rows.get(key)) is not None:
+                self._store(key, row, now)
+            else:
+                self.evict(key)
+                self._missing.add(key)
+            future.set_result(row)
+
+    def upsert(self, key, row):
+        """Replaces the cached row for `key` with a freshly returned record"""
+        if row is None:
+            return self.evict(key)
+        row = self._row(row)
+        self._store(key, row)
+        return row
+
+    def patch(self, key, **fields):
+        """Updates columns of an already cached row"""
+        if (row := self.get(key)) is not None:
+            row.update(fields)
+        return row
+
+    def evict(self, key):
+        self._loaded.pop(key, None)
+        self._missing.discard(key)
+        return self.pop(key, None)
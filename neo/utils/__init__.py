@@ -20,5 +20,6 @@ from .converters import *
 from .errors import *
 from .eval_backend import *
 from .formatters import *
+from .highlight_engine import *
 from .paginator import *
 from .truck_month import get_next_truck_month, rdelta_filter_null
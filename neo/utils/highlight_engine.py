@@ -0,0 +1,679 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import re2  # Linear time matching, so user patterns can't backtrack catastrophically
+
+__all__ = (
+    "BaseHighlight",
+    "KeywordTrie",
+    "MatchUnit",
+    "HighlightMatcher",
+    "HighlightIndex",
+    "HighlightPolicy",
+    "MatchWorkerPool",
+)
+
+log = logging.getLogger(__name__)
+
+# CPU seconds a single regex search may take. Every pattern runs under RE2,
+# so a search can't run away before it's timed. Searches are timed with
+# the thread's CPU clock, so waiting on the GIL or a GC pause isn't counted
+REGEX_BUDGET = 0.025
+OVERRUN_LIMIT = 3  # Consecutive overruns before a pattern is disabled
+RESYNC_ATTEMPTS = 3  # Changes sent to a stale worker process before a full snapshot
+
+HighlightPolicy = namedtuple("HighlightPolicy", "whitelist blocks")
+EMPTY_POLICY = HighlightPolicy(frozenset(), frozenset())
+
+_END = None  # Trie key under which a terminal node stores its owners
+boundary_re = re.compile(r"\b")
+
+
+def word_boundaries(text):
+    return {m.start() for m in boundary_re.finditer(text)}
+
+
+def compile_pattern(pattern):
+    """Compiles with RE2, raising re.error for patterns it doesn't support,
+    like ones with lookarounds or backreferences"""
+    try:
+        return re2.compile(f"(?i){pattern}")
+    except re2.error as e:
+        raise re.error(str(e)) from None
+
+
+class BaseHighlight:
+    """The part of a highlight needed for matching, which worker processes can
+    rebuild from a (user_id, kw, is_regex) row.
+
+    Patterns that aren't valid regexes at all are matched as text. Valid ones
+    that RE2 can't compile, which only applies to highlights added before
+    they were rejected, are left without a `compiled` pattern, and the
+    matcher keeps them disabled"""
+
+    def __init__(self, user_id, kw, is_regex=True):
+        self.user_id = user_id
+        self.kw = kw
+        self.is_regex = is_regex
+        self.key = (user_id, kw, is_regex)
+        self.compiled = re.compile(fr"\b{re.escape(kw)}\b", re.I)
+        if is_regex:
+            try:
+                self.compiled = compile_pattern(kw)
+            except re.error:
+                try:
+                    re.compile(kw)
+                except re.error:
+                    self.is_regex = False
+                else:
+                    self.compiled = None  # Lookarounds, backreferences, etc
+
+    @property
+    def unsupported(self):
+        """Whether this is a regex that RE2 can't run"""
+        return self.is_regex and self.compiled is None
+
+    def __repr__(self):
+        attrs = " ".join(f"{k}={v!r}" for k, v in self.__dict__.items())
+        return f"<{self.__class__.__name__} {attrs}>"
+
+
+class KeywordTrie:
+    """A character trie of lowercased keywords, each owned by one or more highlights.
+
+    Scanning only starts walks at word boundaries, which is where every
+    `\\bkw\\b` highlight has to begin, so a message is covered in a single pass
+    regardless of how many keywords are stored. Owners are keyed by their
+    `Highlight.key`, since one user can own keywords that only differ in case."""
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, keyword, owner_key, owner):
+        node = self.root
+        for char in keyword.lower():
+            node = node.setdefault(char, {})
+        # Owners are replaced rather than changed, so scans can iterate them
+        # without a lock
+        owners = node.get(_END, {})
+        if owner_key not in owners:
+            self.size += 1
+        node[_END] = {**owners, owner_key: owner}
+
+    def discard(self, keyword, owner_key):
+        path = [self.root]
+        key = keyword.lower()
+        for char in key:
+            if (node := path[-1].get(char)) is None:
+                return
+            path.append(node)
+        owners = path[-1].get(_END, {})
+        if owner_key not in owners:
+            return
+        self.size -= 1
+        if len(owners) > 1:
+            path[-1][_END] = {k: v for k, v in owners.items() if k != owner_key}
+        else:
+            del path[-1][_END]
+        # Prune the branches that no longer lead to a keyword
+        for char, parent, node in zip(reversed(key), reversed(path[:-1]), reversed(path)):
+            if node:
+                break
+            del parent[char]
+
+    def scan(self, content):
+        """Yields (owners, start, end) for every keyword bounded by word boundaries"""
+        text = content.lower()
+        bounds = word_boundaries(text)
+        length = len(text)
+        for start in sorted(bounds):
+            node = self.root
+            index = start
+            while index < length and (node := node.get(text[index])) is not None:
+                index += 1
+                if index in bounds and (owners := node.get(_END)) is not None:
+                    yield owners, start, index
+
+
+class MatchUnit:
+    """A single compiled search covering one or more of a user's regex highlights,
+    which also keeps track of how long its searches take"""
+
+    __slots__ = ("compiled", "highlights", "calls", "total", "worst", "overruns")
+
+    def __init__(self, compiled, highlights):
+        self.compiled = compiled
+        self.highlights = highlights
+        self.calls = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.overruns = 0  # Consecutive searches over the budget
+
+    def __repr__(self):
+        return "<{0.__class__.__name__} highlights={1} calls={0.calls} worst={0.worst:.6f}>".format(
+            self, len(self.highlights)
+        )
+
+    @property
+    def mean(self):
+        return self.total / self.calls if self.calls else 0.0
+
+    def search(self, content):
+        start = time.thread_time()
+        match = self.compiled.search(content)
+        elapsed = time.thread_time() - start
+        self.add_timing(elapsed)
+        return match, elapsed
+
+    def add_timing(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.worst:
+            self.worst = elapsed
+
+    def overran(self, elapsed, budget):
+        """Whether a search overran `budget`, keeping count of consecutive overruns"""
+        if elapsed > budget:
+            self.overruns += 1
+            return True
+        self.overruns = 0
+        return False
+
+    def highlight_for(self, match):
+        if len(self.highlights) == 1:
+            return self.highlights[0]
+        name = getattr(match, "lastgroup", None)
+        if not (name and name.startswith("_hl")):
+            name = next(
+                k
+                for k, v in match.groupdict().items()
+                if k.startswith("_hl") and v is not None
+            )
+        return self.highlights[int(name[3:])]
+
+
+class HighlightMatcher:
+    """Matches every highlight against a message in one pass.
+
+    Literal highlights live in a shared `KeywordTrie`, while each user's regex
+    highlights are merged into a single alternation where possible. The
+    matcher is patched per highlight, so updates never rebuild it wholesale.
+
+    Regex searches are timed against `budget`. A merged search that overruns
+    it is split back into one search per pattern so the cost can be pinned
+    on a single highlight, and a single pattern that overruns it on
+    `overrun_limit` consecutive searches is disabled and passed to
+    `on_disable`.
+
+    Every change bumps `version` and is kept in a log of the last `history`
+    changes, so copies in worker processes can be brought up to date without
+    resending everything. Changes go through `lock`, but scans don't take it:
+    the trie's owners and `merged` are replaced rather than changed, so a
+    scan searches whatever was current when it started and worker threads
+    never block the event loop patching the matcher."""
+
+    def __init__(
+        self,
+        *,
+        budget=REGEX_BUDGET,
+        overrun_limit=OVERRUN_LIMIT,
+        on_disable=None,
+        history=1000,
+    ):
+        self.keywords = KeywordTrie()
+        self.highlights = {}  # Highlight.key -> Highlight
+        self.patterns = {}  # user_id -> {kw: Highlight}
+        self.merged = {}  # user_id -> (MatchUnit, ...), replaced on every change
+        self.disabled = {}  # Highlight.key -> Highlight
+        self.budget = budget
+        self.overrun_limit = overrun_limit
+        self.on_disable = on_disable
+        self.version = 0
+        self.changes = deque(maxlen=history)  # (version, op, key)
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.highlights)
+
+    def add(self, hl, *, disabled=False):
+        """Adds a highlight, already disabled if `disabled` is set, e.g. for
+        one that was disabled before a restart. Unsupported regexes are
+        always disabled"""
+        with self.lock:
+            self._changed("add_disabled" if disabled else "add", hl.key)
+            self.highlights[hl.key] = hl
+            if hl.is_regex:
+                if disabled or hl.unsupported:
+                    self.disabled[hl.key] = hl
+                self.patterns.setdefault(hl.user_id, {})[hl.kw] = hl
+                self._merge(hl.user_id)
+            else:
+                self.keywords.add(hl.kw, hl.key, hl)
+
+    def discard(self, hl):
+        with self.lock:
+            self._changed("discard", hl.key)
+            self.highlights.pop(hl.key, None)
+            if hl.is_regex:
+                self.disabled.pop(hl.key, None)
+                if (user_patterns := self.patterns.get(hl.user_id)) is None:
+                    return
+                user_patterns.pop(hl.kw, None)
+                self._merge(hl.user_id)
+            else:
+                self.keywords.discard(hl.kw, hl.key)
+
+    def disable(self, key, elapsed):
+        if (hl := self._disable(key)) is not None and self.on_disable is not None:
+            self.on_disable(hl, elapsed)
+
+    def _disable(self, key):
+        with self.lock:
+            if (hl := self.highlights.get(key)) is None or key in self.disabled:
+                return None
+            self._changed("disable", key)
+            self.disabled[key] = hl
+            self._merge(hl.user_id)
+            return hl
+
+    def _changed(self, op, key):
+        self.version += 1
+        self.changes.append((self.version, op, key))
+
+    def changes_since(self, version):
+        """The changes made after `version`, or None if they're no longer all
+        in the log and a full snapshot is needed instead"""
+        with self.lock:
+            if version == self.version:
+                return []
+            if version > self.version or not self.changes:
+                return None
+            if self.changes[0][0] > version + 1:
+                return None
+            return [change for change in self.changes if change[0] > version]
+
+    def apply(self, changes):
+        """Replays changes from another matcher's `changes_since`, without
+        calling `on_disable` for the disables among them"""
+        with self.lock:
+            for version, op, key in changes:
+                if op == "discard":
+                    if (hl := self.highlights.get(key)) is not None:
+                        self.discard(hl)
+                elif op == "disable":
+                    self._disable(key)
+                else:
+                    self.add(BaseHighlight(*key), disabled=op == "add_disabled")
+                # Changes this copy already made itself don't bump it again
+                self.version = version
+
+    def snapshot(self):
+        """A picklable copy of the matcher's contents, for worker processes"""
+        with self.lock:
+            return (
+                self.version,
+                [*self.highlights.keys()],
+                [*self.disabled.keys()],
+            )
+
+    @classmethod
+    def from_snapshot(cls, snapshot, **kwargs):
+        version, keys, disabled = snapshot
+        matcher = cls(**kwargs)
+        disabled = {*disabled}
+        for key in keys:
+            matcher.add(BaseHighlight(*key), disabled=key in disabled)
+        matcher.version = version
+        return matcher
+
+    def _merge(self, user_id):
+        if not self.patterns.get(user_id):
+            self.patterns.pop(user_id, None)
+        highlights = [
+            hl
+            for hl in self.patterns.get(user_id, {}).values()
+            if hl.key not in self.disabled
+        ]
+        if not highlights:
+            self._set_units(user_id, ())
+            return
+        units = []
+        if len(highlights) > 1:
+            pattern = "|".join(
+                f"(?P<_hl{i}>{hl.kw})" for i, hl in enumerate(highlights)
+            )
+            try:
+                compiled = compile_pattern(pattern)
+            except re.error:  # Conflicting group names, misplaced global flags, etc
+                units.extend(map(self._single, highlights))
+            else:
+                units.append(MatchUnit(compiled, highlights))
+        else:
+            units.extend(map(self._single, highlights))
+        self._set_units(user_id, units)
+
+    def _set_units(self, user_id, units):
+        merged = self.merged.copy()
+        if units:
+            merged[user_id] = tuple(units)
+        else:
+            merged.pop(user_id, None)
+        self.merged = merged
+
+    @staticmethod
+    def _single(hl):
+        return MatchUnit(hl.compiled, [hl])
+
+    def _over_budget(self, user_id, unit, elapsed):
+        with self.lock:
+            units = self.merged.get(user_id, ())
+            if unit not in units:
+                return
+            if len(unit.highlights) > 1:
+                split = map(self._single, unit.highlights)
+                self._set_units(user_id, [*(u for u in units if u is not unit), *split])
+                return
+            if unit.overruns < self.overrun_limit:
+                return
+        self.disable(unit.highlights[0].key, elapsed)
+
+    def costs(self):
+        """Returns every regex search unit, most expensive first"""
+        units = [unit for units in self.merged.values() for unit in units]
+        return sorted(units, key=lambda unit: unit.total, reverse=True)
+
+    def record(self, searches):
+        """Adds timings from another copy's `scan` to the matching units,
+        splitting or disabling them as if the searches had been run here"""
+        for user_id, keys, elapsed in searches:
+            for unit in self.merged.get(user_id, ()):
+                if tuple(hl.key for hl in unit.highlights) == keys:
+                    break
+            else:
+                continue  # Changed since the copy searched it
+            unit.add_timing(elapsed)
+            if unit.overran(elapsed, self.budget):
+                self._over_budget(user_id, unit, elapsed)
+
+    def scan(self, content, searches=None):
+        """Returns a list of (Highlight, matched_text), at most one per user.
+
+        If `searches` is given, (user_id, highlight keys, elapsed) is
+        appended to it for every regex search, to be passed to `record`"""
+        found, overruns = self._scan(content, searches)
+        for overrun in overruns:
+            self._over_budget(*overrun)
+        return found
+
+    def _scan(self, content, searches=None):
+        found = {}
+        overruns = []
+        same_length = len(content.lower()) == len(content)
+        for owners, start, end in self.keywords.scan(content):
+            for hl in owners.values():
+                if hl.user_id not in found:
+                    found[hl.user_id] = (
+                        hl,
+                        content[start:end] if same_length else hl.kw,
+                    )
+        for user_id, units in self.merged.items():  # The dict itself is never changed
+            if user_id in found:
+                continue
+            for unit in units:
+                match, elapsed = unit.search(content)
+                if searches is not None:
+                    searches.append(
+                        (user_id, tuple(hl.key for hl in unit.highlights), elapsed)
+                    )
+                if unit.overran(elapsed, self.budget):
+                    overruns.append((user_id, unit, elapsed))
+                if match is None:
+                    continue
+                found[user_id] = (unit.highlight_for(match), match.group(0))
+                break
+        return [*found.values()], overruns
+
+
+_process_state = {"matcher": None}
+
+
+def scan_in_process(version, update, content):
+    """Runs inside a worker process, first applying `update` if one is given.
+
+    `update` is either ("snapshot", snapshot) or ("changes", base, changes),
+    which only applies to a matcher at version `base`. Returns the matcher's
+    version along with the results, which are None when the matcher is stale.
+    Results include the timing of every search, for the event loop's matcher
+    to `record`."""
+    matcher = _process_state["matcher"]
+    if update is not None and update[0] == "snapshot":
+        matcher = _process_state["matcher"] = HighlightMatcher.from_snapshot(
+            update[1], history=0
+        )
+    elif update is not None and matcher is not None and matcher.version == update[1]:
+        matcher.apply(update[2])
+    if matcher is None or matcher.version != version:
+        return None if matcher is None else matcher.version, None
+    searches = []
+    found = [(hl.key, text) for hl, text in matcher.scan(content, searches)]
+    # Splitting and disabling here is only provisional, the event loop's
+    # matcher sends disables back as changes, so this copy's version has to
+    # stay in step
+    matcher.version = version
+    return version, (found, searches)
+
+
+class MatchWorkerPool:
+    """Runs highlight matching off the event loop.
+
+    Jobs wait in a bounded queue which sheds either its oldest or the newest
+    job when full. Results are handed to `consumer(payload, matches)` on the
+    event loop. Thread workers share the matcher; process workers keep a
+    copy that's sent the changes made since its version, or resent whole when
+    those have fallen out of the matcher's log, and send their search timings
+    back so the matcher's costs cover them too."""
+
+    def __init__(
+        self,
+        matcher,
+        consumer,
+        *,
+        workers=2,
+        mode="thread",
+        queue_size=1000,
+        shedding="oldest",
+        timeout=5.0,
+    ):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown worker mode {mode!r}")
+        if shedding not in ("oldest", "newest"):
+            raise ValueError(f"Unknown shedding strategy {shedding!r}")
+        self.matcher = matcher
+        self.consumer = consumer
+        self.workers = workers
+        self.mode = mode
+        self.shedding = shedding
+        self.timeout = timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.stats = Counter()
+        self.tasks = []
+        executor = ThreadPoolExecutor if mode == "thread" else ProcessPoolExecutor
+        self.executor = executor(max_workers=workers)
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self.tasks = [loop.create_task(self._work()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.executor.shutdown(wait=False)
+
+    def submit(self, content, payload):
+        if self.queue.full():
+            self.stats["shed"] += 1
+            if self.shedding == "newest":
+                return False
+            self.queue.get_nowait()
+            self.queue.task_done()
+        self.queue.put_nowait((content, payload))
+        self.stats["submitted"] += 1
+        return True
+
+    async def _work(self):
+        while True:
+            content, payload = await self.queue.get()
+            try:
+                matches = await asyncio.wait_for(self._scan(content), self.timeout)
+                await self.consumer(payload, matches)
+            except asyncio.TimeoutError:
+                self.stats["timed_out"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.stats["failed"] += 1
+                log.exception("Offloaded highlight matching failed")
+            else:
+                self.stats["completed"] += 1
+            finally:
+                self.queue.task_done()
+
+    async def _scan(self, content):
+        loop = asyncio.get_event_loop()
+        if self.mode == "thread":
+            return await loop.run_in_executor(self.executor, self.matcher.scan, content)
+        version, update = self.matcher.version, None
+        misses = 0
+        while True:
+            seen, result = await loop.run_in_executor(
+                self.executor, scan_in_process, version, update, content
+            )
+            if result is not None:
+                break
+            # Each call can land on a different process, so after a few
+            # misses the whole snapshot is sent, which applies to any of them
+            misses += 1
+            changes = None
+            if seen is not None and misses < RESYNC_ATTEMPTS:
+                changes = self.matcher.changes_since(seen)
+            if changes is None:
+                self.stats["resynced"] += 1
+                update = ("snapshot", self.matcher.snapshot())
+                version = update[1][0]
+            else:
+                self.stats["patched"] += 1
+                update = ("changes", seen, changes)
+                version = changes[-1][0] if changes else seen
+        found, searches = result
+        self.matcher.record(searches)
+        return [
+            (self.matcher.highlights[key], text)
+            for key, text in found
+            if key in self.matcher.highlights
+        ]
+
+
+def member_ids(guild):
+    """The guild's members keyed by id. Guild.members copies these into a new
+    list on every access, which is too slow to do per guild and owner"""
+    return guild._members
+
+
+class HighlightIndex:
+    """Tracks which highlight owners are members of which guilds, along with
+    each owner's whitelist and blocks, so sending checks are O(1) lookups."""
+
+    def __init__(self):
+        self.guilds = defaultdict(set)  # guild_id -> {owner_id, ...}
+        self.memberships = defaultdict(set)  # owner_id -> {guild_id, ...}
+        self.policies = {}
+
+    @property
+    def owners(self):
+        return self.memberships.keys()
+
+    def is_member(self, guild_id, user_id):
+        return user_id in self.guilds.get(guild_id, ())
+
+    def add_member(self, guild_id, user_id):
+        self.guilds[guild_id].add(user_id)
+        self.memberships[user_id].add(guild_id)
+
+    def remove_member(self, guild_id, user_id):
+        if (members := self.guilds.get(guild_id)) is not None:
+            members.discard(user_id)
+        if (guilds := self.memberships.get(user_id)) is not None:
+            guilds.discard(guild_id)
+
+    def add_owner(self, user_id, guilds):
+        self.memberships.setdefault(user_id, set())
+        for guild in guilds:
+            if guild.get_member(user_id):
+                self.add_member(guild.id, user_id)
+
+    def add_owners(self, user_ids, guilds):
+        """Adds many owners at once, going over each guild's members once
+        rather than looking every owner up in every guild"""
+        user_ids = {*user_ids}
+        for user_id in user_ids:
+            self.memberships.setdefault(user_id, set())
+        for guild in guilds:
+            self._add_members(guild, user_ids)
+
+    def remove_owner(self, user_id):
+        for guild_id in self.memberships.pop(user_id, ()):
+            self.guilds[guild_id].discard(user_id)
+        self.policies.pop(user_id, None)
+
+    def add_guild(self, guild):
+        self._add_members(guild, self.owners)
+
+    def _add_members(self, guild, owners):
+        # Whichever side is smaller is iterated, looking ids up in the other
+        members = member_ids(guild)
+        if len(owners) < len(members):
+            found = [uid for uid in owners if uid in members]
+        else:
+            found = [uid for uid in members if uid in owners]
+        for user_id in found:
+            self.add_member(guild.id, user_id)
+
+    def remove_guild(self, guild_id):
+        for user_id in self.guilds.pop(guild_id, ()):
+            self.memberships[user_id].discard(guild_id)
+
+    def set_policy(self, user_id, settings):
+        settings = settings or {}
+        self.policies[user_id] = HighlightPolicy(
+            frozenset(settings.get("hl_whitelist") or ()),
+            frozenset(settings.get("hl_blocks") or ()),
+        )
+
+    def policy(self, user_id):
+        return self.policies.get(user_id, EMPTY_POLICY)